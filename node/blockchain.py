@@ -1,7 +1,10 @@
 import time
+from collections import OrderedDict
 from threading import Event
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
+from .mining import MiningPool, PowTemplate
+from .template import BlockTemplate
 from .transactions import (
     COINBASE_SIGNATURE,
     SignedTransaction,
@@ -9,40 +12,24 @@ from .transactions import (
     deserialize_signed_transactions,
     serialize_signed_transactions,
     validate_transactions,
+    verify_all_signatures,
 )
-from .utils import hash_dict
+from .utils import hash_dict, merkle_leaf, merkle_root
 
 MINING_REWARD = 50.0
-MINING_MIN = 10
+UNDO_DEPTH = 100
 
+LEGACY_BLOCK_VERSION = 1
+MERKLE_BLOCK_VERSION = 2
+BLOCK_VERSION = MERKLE_BLOCK_VERSION
 
-def calculate_balance_with_mempool(
-        chain: List["Block"],
-        public_key: str,
-        pending_transactions: List[SignedTransaction]
-) -> float:
-    balance = 0.0
 
-    for block in chain:
-        for signed_tx in block.txs:
-            tx = signed_tx.transaction
-
-            if tx.recipient == public_key:
-                balance += tx.amount
-
-            if tx.sender == public_key:
-                balance -= tx.amount
+def block_work(block: "Block") -> int:
+    return header_work(block.difficulty)
 
-    for signed_tx in pending_transactions:
-        tx = signed_tx.transaction
 
-        if tx.sender == public_key:
-            balance -= tx.amount
-
-        if tx.recipient == public_key:
-            balance += tx.amount
-
-    return balance
+def header_work(difficulty: int) -> int:
+    return 16 ** max(0, int(difficulty))
 
 
 class Block:
@@ -56,6 +43,8 @@ class Block:
             difficulty: int,
             miner: str,
             block_hash: str,
+            version: int = LEGACY_BLOCK_VERSION,
+            merkle_root: Optional[str] = None,
     ):
         self.height = height
         self.prev_hash = prev_hash
@@ -65,8 +54,31 @@ class Block:
         self.difficulty = difficulty
         self.miner = miner
         self.hash = block_hash
+        self.version = version
+        if merkle_root is None and version >= MERKLE_BLOCK_VERSION:
+            merkle_root = self.compute_merkle_root()
+        self.merkle_root = merkle_root
+
+    def compute_merkle_root(self) -> str:
+        return merkle_root([merkle_leaf(signed_tx.transaction.txid, signed_tx.signature) for signed_tx in self.txs])
+
+    def has_valid_merkle_root(self) -> bool:
+        if self.version < MERKLE_BLOCK_VERSION:
+            return True
+        return self.merkle_root == self.compute_merkle_root()
 
     def header(self) -> Dict:
+        if self.version >= MERKLE_BLOCK_VERSION:
+            return {
+                "version": self.version,
+                "height": self.height,
+                "prev_hash": self.prev_hash,
+                "timestamp": self.timestamp,
+                "merkle_root": self.merkle_root,
+                "nonce": self.nonce,
+                "difficulty": self.difficulty,
+                "miner": self.miner,
+            }
         return {
             "height": self.height,
             "prev_hash": self.prev_hash,
@@ -77,25 +89,58 @@ class Block:
             "miner": self.miner,
         }
 
+    def header_dict(self) -> Dict:
+        data = self.header()
+        data["hash"] = self.hash
+        return data
+
     def to_dict(self) -> Dict:
         data = self.header()
+        if self.version >= MERKLE_BLOCK_VERSION:
+            data["txs"] = serialize_signed_transactions(self.txs)
         data["hash"] = self.hash
         return data
 
     @classmethod
-    def from_dict(cls, d: Dict) -> "Block":
+    def from_dict(cls, d: Dict, trusted: bool = False, verify_signatures: bool = True) -> "Block":
+        version = int(d.get("version", LEGACY_BLOCK_VERSION))
         return cls(
             height=int(d["height"]),
             prev_hash=str(d["prev_hash"]),
             timestamp=int(d["timestamp"]),
-            txs=deserialize_signed_transactions(d["txs"]),
+            txs=deserialize_signed_transactions(d["txs"], trusted=trusted, verify_signatures=verify_signatures),
             nonce=int(d["nonce"]),
             difficulty=int(d["difficulty"]),
             miner=str(d["miner"]),
             block_hash=str(d["hash"]),
+            version=version,
+            merkle_root=str(d["merkle_root"]) if version >= MERKLE_BLOCK_VERSION else None,
         )
 
 
+def deserialize_chain(chain_dicts: List[Dict]) -> List[Block]:
+    """Parse a chain received from a peer, verifying all of its signatures as one parallel batch."""
+    chain = [Block.from_dict(d, verify_signatures=False) for d in chain_dicts]
+    if not verify_all_signatures([signed_tx for blk in chain for signed_tx in blk.txs]):
+        raise ValueError("Invalid signature in chain")
+    return chain
+
+
+def block_locator(chain: List[Block]) -> List[str]:
+    """Hashes of the last 10 blocks, then exponentially sparser ones, always ending with genesis."""
+    locator: List[str] = []
+    height = len(chain) - 1
+    step = 1
+    while height > 0:
+        locator.append(chain[height].hash)
+        if len(locator) >= 10:
+            step *= 2
+        height -= step
+    if chain:
+        locator.append(chain[0].hash)
+    return locator
+
+
 class Blockchain:
     def __init__(self, difficulty: int):
         if difficulty <= 0:
@@ -117,7 +162,16 @@ class Blockchain:
         return SignedTransaction(transaction, signature=COINBASE_SIGNATURE)
 
     def validate_block(self, block: Block, prev: Optional[Block]) -> bool:
+        if block.version not in (LEGACY_BLOCK_VERSION, MERKLE_BLOCK_VERSION):
+            return False
+        if not block.has_valid_merkle_root():
+            return False
+        if block.difficulty != self.difficulty:
+            return False
+
         if block.height == 0:
+            if prev is not None or block.txs:
+                return False
             expected = hash_dict(block.header())
             return block.prev_hash == "0" * 64 and block.hash == expected
 
@@ -141,62 +195,192 @@ class Blockchain:
 
         return True
 
-    def mine_next_block(self, prev: Block, miner_id: str, txs: List[SignedTransaction], stop_event: Optional["Event"] = None) -> Optional[Block]:
+    def validate_header(self, header: Dict, prev_hash: str, prev_height: int) -> bool:
+        """Check linkage, difficulty and PoW of a header received as ``Block.header_dict()``, without its transactions."""
+        try:
+            fields = {k: v for k, v in header.items() if k != "hash"}
+            if int(fields["height"]) != prev_height + 1 or fields["prev_hash"] != prev_hash:
+                return False
+            if int(fields.get("version", LEGACY_BLOCK_VERSION)) not in (LEGACY_BLOCK_VERSION, MERKLE_BLOCK_VERSION):
+                return False
+            if int(fields["difficulty"]) != self.difficulty:
+                return False
+            if hash_dict(fields) != header["hash"]:
+                return False
+            return self.is_pow_valid(header["hash"], int(fields["difficulty"]))
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def mine_next_block(self, prev: Block, miner_id: str, template: Union[BlockTemplate, List[SignedTransaction]],
+                        stop_event: Optional["Event"] = None, pool: Optional[MiningPool] = None) -> Optional[Block]:
+        txs = template.transactions() if isinstance(template, BlockTemplate) else list(template)
         coinbase = self.create_coinbase_transaction(miner_id)
-        all_txs = [coinbase] + txs
+        block = Block(
+            height=prev.height + 1,
+            prev_hash=prev.hash,
+            timestamp=int(time.time()),
+            txs=[coinbase] + txs,
+            nonce=0,
+            difficulty=self.difficulty,
+            miner=miner_id,
+            block_hash="",
+            version=BLOCK_VERSION,
+        )
 
-        height = prev.height + 1
-        nonce = 0
-        while True:
-            if stop_event is not None and getattr(stop_event, "is_set", None) and stop_event.is_set():
-                return None
-            block_data = {
-                "height": height,
-                "prev_hash": prev.hash,
-                "timestamp": int(time.time()),
-                "txs": serialize_signed_transactions(all_txs),
-                "nonce": nonce,
-                "difficulty": self.difficulty,
-                "miner": miner_id,
-            }
-            h = hash_dict(block_data)
-            block_data["hash"] = h
-            if self.is_pow_valid(h, self.difficulty):
-                return Block.from_dict(block_data)
-            nonce += 1
+        template = PowTemplate(block.header(), self.difficulty)
+        if pool is not None:
+            found = pool.search(template, stop_event=stop_event)
+        else:
+            found = template.search(stop_event=stop_event)
+        if found is None:
+            return None
+        block.nonce, block.hash = found
+        return block
 
     def create_genesis(self) -> Block:
-        block_data = {
-            "height": 0,
-            "prev_hash": "0" * 64,
-            "timestamp": 0,
-            "txs": [],
-            "nonce": 0,
-            "difficulty": self.difficulty,
-            "miner": "genesis",
-        }
-        h = hash_dict(block_data)
-        block_data["hash"] = h
-        return Block.from_dict(block_data)
+        genesis = Block(
+            height=0,
+            prev_hash="0" * 64,
+            timestamp=0,
+            txs=[],
+            nonce=0,
+            difficulty=self.difficulty,
+            miner="genesis",
+            block_hash="",
+            version=BLOCK_VERSION,
+        )
+        genesis.hash = hash_dict(genesis.header())
+        return genesis
 
     def validate_chain(self, chain: List["Block"]) -> bool:
-        prev: Optional[Block] = None
-        balances: Dict[str, float] = {}
+        return ChainState.from_chain(self, chain) is not None
+
+
+class ChainState:
+    """Validated tip of the active chain plus the balance of every account at that tip.
+
+    For the last UNDO_DEPTH connected blocks it keeps the previous balance of every touched account,
+    so a reorg can disconnect blocks back to the fork point exactly.
+    """
 
+    def __init__(self, blockchain: Blockchain):
+        self.blockchain = blockchain
+        self.tip: Optional[Block] = None
+        self.balances: Dict[str, float] = {}
+        self.work = 0
+        self._undo: "OrderedDict[str, Dict[str, Optional[float]]]" = OrderedDict()
+
+    @classmethod
+    def from_chain(cls, blockchain: Blockchain, chain: List[Block]) -> Optional["ChainState"]:
+        if not verify_all_signatures([signed_tx for blk in chain for signed_tx in blk.txs[1:]]):
+            return None
+        state = cls(blockchain)
         for blk in chain:
-            if not self.validate_block(blk, prev):
-                return False
+            if not state.connect(blk):
+                return None
+        return state
 
-            for signed_tx in blk.txs:
-                tx = signed_tx.transaction
+    @property
+    def height(self) -> int:
+        return self.tip.height if self.tip else -1
 
-                if tx.sender:
-                    sender_balance = balances.get(tx.sender, 0.0)
-                    if sender_balance < tx.amount:
-                        return False
-                    balances[tx.sender] = sender_balance - tx.amount
+    def balance_of(self, public_key: str) -> float:
+        return self.balances.get(public_key, 0.0)
+
+    def _updated_balances(self, block: Block, check_funds: bool = True) -> Optional[Dict[str, float]]:
+        updated: Dict[str, float] = {}
+        for signed_tx in block.txs:
+            tx = signed_tx.transaction
 
-                balances[tx.recipient] = balances.get(tx.recipient, 0.0) + tx.amount
+            if tx.sender:
+                sender_balance = updated.get(tx.sender, self.balances.get(tx.sender, 0.0))
+                if check_funds and sender_balance < tx.amount:
+                    return None
+                updated[tx.sender] = sender_balance - tx.amount
 
-            prev = blk
+            updated[tx.recipient] = updated.get(tx.recipient, self.balances.get(tx.recipient, 0.0)) + tx.amount
+        return updated
+
+    def unaffordable_transactions(self, txs: List[SignedTransaction]) -> List[SignedTransaction]:
+        """Transactions of ``txs`` whose sender cannot cover them when applied in order on top of the tip."""
+        running: Dict[str, float] = {}
+        unaffordable: List[SignedTransaction] = []
+        for signed_tx in txs:
+            tx = signed_tx.transaction
+            if tx.sender:
+                sender_balance = running.get(tx.sender, self.balances.get(tx.sender, 0.0))
+                if sender_balance < tx.amount:
+                    unaffordable.append(signed_tx)
+                    continue
+                running[tx.sender] = sender_balance - tx.amount
+            running[tx.recipient] = running.get(tx.recipient, self.balances.get(tx.recipient, 0.0)) + tx.amount
+        return unaffordable
+
+    def connect(self, block: Block) -> bool:
+        if block.height != self.height + 1:
+            return False
+        if not self.blockchain.validate_block(block, self.tip):
+            return False
+        updated = self._updated_balances(block)
+        if updated is None:
+            return False
+        self._undo[block.hash] = {key: self.balances.get(key) for key in updated}
+        while len(self._undo) > UNDO_DEPTH:
+            self._undo.popitem(last=False)
+        self.balances.update(updated)
+        self.tip = block
+        self.work += block_work(block)
         return True
+
+    def can_disconnect(self, depth: int) -> bool:
+        return depth <= len(self._undo)
+
+    def disconnect(self, prev: Optional[Block]) -> Block:
+        block = self.tip
+        if block is None or (prev.hash if prev else None) != (block.prev_hash if block.height > 0 else None):
+            raise ValueError("prev is not the parent of the current tip")
+        undo = self._undo.pop(block.hash, None)
+        if undo is None:
+            raise ValueError(f"No undo data for block {block.hash}")
+        for key, previous in undo.items():
+            if previous is None:
+                self.balances.pop(key, None)
+            else:
+                self.balances[key] = previous
+        self.tip = prev
+        self.work -= block_work(block)
+        return block
+
+    def reset(self, chain: List[Block], balances: Optional[Dict[str, float]] = None,
+              deltas: Optional[Dict[str, Dict[str, float]]] = None) -> None:
+        """Rebuild from blocks that were already validated, e.g. the chain stored in ChainStorage.
+
+        When the balances at the tip are already known (ChainStorage.get_all_balances) they are used as-is.
+        When the per-block balance deltas of the last blocks are given (ChainStorage.get_active_deltas), their
+        undo data is rebuilt by walking back from the tip, so a reorg after a restart still only undoes deltas.
+        """
+        self.tip = chain[-1] if chain else None
+        self.work = sum(block_work(blk) for blk in chain)
+        self._undo.clear()
+        if balances is not None:
+            self.balances = dict(balances)
+        else:
+            self.balances = {}
+            for blk in chain:
+                self.balances.update(self._updated_balances(blk, check_funds=False))
+        if deltas is not None:
+            self._restore_undo(chain[-UNDO_DEPTH:], deltas)
+
+    def _restore_undo(self, blocks: List[Block], deltas: Dict[str, Dict[str, float]]) -> None:
+        records = []
+        previous: Dict[str, float] = {}
+        for blk in reversed(blocks):
+            if blk.hash not in deltas:
+                break
+            record: Dict[str, Optional[float]] = {}
+            for key, delta in deltas.get(blk.hash, {}).items():
+                before = previous.get(key, self.balances.get(key, 0.0)) - delta
+                previous[key] = before
+                record[key] = before if abs(before) > 1e-9 else None
+            records.append((blk.hash, record))
+        self._undo.update(reversed(records))
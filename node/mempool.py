@@ -0,0 +1,348 @@
+import heapq
+import logging
+from collections import OrderedDict
+from threading import RLock
+from typing import Callable, Dict, Iterable, List, Optional, Protocol, Set, Tuple
+
+from .transactions import SignedTransaction, Transaction
+
+logger = logging.getLogger(__name__)
+
+MEMPOOL_MAX_TXS = 50_000
+MEMPOOL_MAX_BYTES = 32 * 1024 * 1024
+MEMPOOL_MAX_PER_SENDER = 5_000
+TX_OVERHEAD_BYTES = 120
+DIGEST_PREFIX_LEN = 2
+
+
+def estimate_size(signed_tx: SignedTransaction) -> int:
+    tx = signed_tx.transaction
+    return TX_OVERHEAD_BYTES + len(tx.sender or "") + len(tx.recipient) + len(signed_tx.signature) + len(tx.txid)
+
+
+class MempoolJournal(Protocol):
+    def record_add(self, tx: Dict) -> None: ...
+
+    def record_remove(self, txid: str) -> None: ...
+
+
+class Mempool:
+    """Pending transactions in arrival order, keyed by txid.
+
+    Per-account totals of pending spends and receipts are kept up to date on every add and remove,
+    so admission and balance queries do not depend on the mempool size.
+
+    The pool is bounded by transaction count, estimated bytes and transactions per sender. When full,
+    the oldest transactions are evicted; pending spends that relied on an evicted receipt and are no
+    longer affordable at their place in the arrival order are evicted with it. Every transaction is thus
+    covered by its sender's confirmed balance plus the pending transactions that arrived before it, so
+    the arrival order (and any prefix of it) is a valid block body.
+    """
+
+    def __init__(
+            self,
+            confirmed_balance: Callable[[str], float],
+            max_txs: int = MEMPOOL_MAX_TXS,
+            max_bytes: int = MEMPOOL_MAX_BYTES,
+            max_per_sender: int = MEMPOOL_MAX_PER_SENDER,
+            journal: Optional[MempoolJournal] = None,
+    ):
+        self.confirmed_balance = confirmed_balance
+        self.journal = journal
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.max_per_sender = max_per_sender
+        self._txs: "OrderedDict[str, SignedTransaction]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._by_sender: Dict[str, "OrderedDict[str, None]"] = {}
+        self._by_recipient: Dict[str, "OrderedDict[str, None]"] = {}
+        self._seq: Dict[str, int] = {}
+        self._next_seq = 0
+        self._spend: Dict[str, float] = {}
+        self._receive: Dict[str, float] = {}
+        self._bytes = 0
+        self._buckets: Dict[str, Set[str]] = {}
+        self._bucket_xor: Dict[str, int] = {}
+        self._counters = {
+            "evicted": 0,
+            "evicted_bytes": 0,
+            "evicted_dependent": 0,
+            "rejected_quota": 0,
+            "rejected_full": 0,
+            "restored": 0,
+            "dropped_invalid": 0,
+        }
+        self._lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self._txs)
+
+    def __contains__(self, txid: str) -> bool:
+        return txid in self._txs
+
+    def get(self, txid: str) -> Optional[SignedTransaction]:
+        return self._txs.get(txid)
+
+    def transactions(self) -> List[SignedTransaction]:
+        with self._lock:
+            return list(self._txs.values())
+
+    def txids(self) -> List[str]:
+        with self._lock:
+            return list(self._txs)
+
+    @property
+    def evicted_count(self) -> int:
+        return self._counters["evicted"]
+
+    def size_of(self, txid: str) -> int:
+        return self._sizes.get(txid, 0)
+
+    def oldest(self, max_txs: int, max_bytes: int) -> List[Tuple[SignedTransaction, int]]:
+        """Longest prefix of the arrival order (with estimated sizes) within ``max_txs`` and ``max_bytes``."""
+        prefix: List[Tuple[SignedTransaction, int]] = []
+        total = 0
+        with self._lock:
+            for txid, signed_tx in self._txs.items():
+                size = self._sizes[txid]
+                if len(prefix) >= max_txs or total + size > max_bytes:
+                    break
+                prefix.append((signed_tx, size))
+                total += size
+        return prefix
+
+    def balance_delta(self, public_key: str) -> float:
+        with self._lock:
+            return self._receive.get(public_key, 0.0) - self._spend.get(public_key, 0.0)
+
+    def available(self, public_key: str) -> float:
+        return self.confirmed_balance(public_key) + self.balance_delta(public_key)
+
+    def add(self, signed_tx: SignedTransaction) -> None:
+        """Admit ``signed_tx`` if its sender can afford it, evicting the oldest transactions when the pool is full."""
+        tx = signed_tx.transaction
+        if tx.sender is None:
+            raise ValueError("Coinbase transaction rejected - coinbase can only be created during mining")
+
+        size = estimate_size(signed_tx)
+        with self._lock:
+            if tx.txid in self._txs:
+                raise ValueError("Transaction already in mempool")
+            if len(self._by_sender.get(tx.sender, ())) >= self.max_per_sender:
+                self._counters["rejected_quota"] += 1
+                raise ValueError(f"Sender has too many pending transactions (limit {self.max_per_sender})")
+            if size > self.max_bytes or self.max_txs <= 0:
+                self._counters["rejected_full"] += 1
+                raise ValueError("Mempool is full")
+
+            self._check_funds(tx)
+            while self._txs and (len(self._txs) + 1 > self.max_txs or self._bytes + size > self.max_bytes):
+                self._evict(next(iter(self._txs)))
+            try:
+                self._check_funds(tx)
+            except ValueError:
+                self._counters["rejected_full"] += 1
+                raise
+
+            self._insert(signed_tx, size)
+
+    def digest(self) -> Dict[str, Dict]:
+        """Per-bucket summary of the txid set: txids are bucketed by their first ``DIGEST_PREFIX_LEN`` hex
+        digits, and each bucket is described by its size and the XOR of its txids. Both are maintained on every
+        add and remove, so two pools can find the buckets they disagree on without listing any txids."""
+        with self._lock:
+            return {
+                prefix: {"count": len(txids), "xor": format(self._bucket_xor[prefix], "064x")}
+                for prefix, txids in self._buckets.items()
+            }
+
+    def txids_in_buckets(self, prefixes: Iterable[str]) -> Dict[str, List[str]]:
+        with self._lock:
+            return {prefix: sorted(self._buckets.get(prefix, ())) for prefix in prefixes}
+
+    def _check_funds(self, tx: Transaction) -> None:
+        available = self.available(tx.sender)
+        if available < tx.amount:
+            raise ValueError(f"Insufficient balance: {available} < {tx.amount}")
+
+    def remove(self, txids: Iterable[str]) -> List[SignedTransaction]:
+        """Drop the given txids (unknown ones are ignored); cost is proportional to ``len(txids)``."""
+        removed: List[SignedTransaction] = []
+        with self._lock:
+            for txid in txids:
+                signed_tx = self._pop(txid)
+                if signed_tx is not None:
+                    removed.append(signed_tx)
+        return removed
+
+    def recheck(self, accounts: Iterable[str]) -> List[SignedTransaction]:
+        """Drop pending spends of ``accounts`` that their confirmed balance no longer covers at their place in the
+        arrival order, e.g. after a block with a conflicting spend connected, plus whatever relied on them.
+
+        Costs O(pending transactions of the affected accounts), independent of the mempool size.
+        """
+        with self._lock:
+            dropped = self._drop_unaffordable(accounts)
+            self._counters["dropped_invalid"] += len(dropped)
+        return dropped
+
+    def revalidate(self, restore: Iterable[SignedTransaction] = (), exclude: Iterable[str] = ()) -> Tuple[int, int]:
+        """Rebuild the pool after the tip changed, in one pass over ``restore`` followed by the current pool.
+
+        ``restore`` are transactions from disconnected blocks, in chain order; they go first, since pending
+        transactions may spend their outputs. Transactions in ``exclude`` (confirmed by the new blocks) are left
+        out. Every candidate is checked against the sender's running balance, i.e. the confirmed balance at the
+        new tip plus the pending transactions kept so far, so the pass costs O(mempool). Returns the number of
+        restored transactions and of previously pending ones dropped as unaffordable or over the limits.
+        """
+        excluded = set(exclude)
+        with self._lock:
+            current = list(self._txs.values())
+            restored_txids = set()
+            candidates: List[SignedTransaction] = []
+            for signed_tx in restore:
+                txid = signed_tx.transaction.txid
+                if signed_tx.transaction.sender is None or txid in excluded or txid in self._txs or txid in restored_txids:
+                    continue
+                restored_txids.add(txid)
+                candidates.append(signed_tx)
+            candidates.extend(signed_tx for signed_tx in current if signed_tx.transaction.txid not in excluded)
+
+            for txid in list(self._txs):
+                self._pop(txid)
+
+            restored = dropped = 0
+            for signed_tx in candidates:
+                tx = signed_tx.transaction
+                size = estimate_size(signed_tx)
+                fits = (len(self._txs) < self.max_txs and self._bytes + size <= self.max_bytes
+                        and len(self._by_sender.get(tx.sender, ())) < self.max_per_sender)
+                if fits and self.available(tx.sender) >= tx.amount:
+                    self._insert(signed_tx, size)
+                    if tx.txid in restored_txids:
+                        restored += 1
+                elif tx.txid not in restored_txids:
+                    dropped += 1
+            self._counters["restored"] += restored
+            self._counters["dropped_invalid"] += dropped
+        return restored, dropped
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(
+                self._counters,
+                size=len(self._txs),
+                bytes=self._bytes,
+                senders=len(self._by_sender),
+                max_txs=self.max_txs,
+                max_bytes=self.max_bytes,
+                max_per_sender=self.max_per_sender,
+            )
+
+    def _insert(self, signed_tx: SignedTransaction, size: int) -> None:
+        tx = signed_tx.transaction
+        self._txs[tx.txid] = signed_tx
+        self._sizes[tx.txid] = size
+        self._bytes += size
+        self._by_sender.setdefault(tx.sender, OrderedDict())[tx.txid] = None
+        if tx.recipient != tx.sender:
+            self._by_recipient.setdefault(tx.recipient, OrderedDict())[tx.txid] = None
+        self._seq[tx.txid] = self._next_seq
+        self._next_seq += 1
+        self._account(tx, 1)
+        self._index_bucket(tx.txid, True)
+        if self.journal is not None:
+            self.journal.record_add(signed_tx.to_dict())
+
+    def _pop(self, txid: str) -> Optional[SignedTransaction]:
+        signed_tx = self._txs.pop(txid, None)
+        if signed_tx is None:
+            return None
+        tx = signed_tx.transaction
+        self._bytes -= self._sizes.pop(txid)
+        pending = self._by_sender.get(tx.sender)
+        if pending is not None:
+            pending.pop(txid, None)
+            if not pending:
+                del self._by_sender[tx.sender]
+        receipts = self._by_recipient.get(tx.recipient)
+        if receipts is not None:
+            receipts.pop(txid, None)
+            if not receipts:
+                del self._by_recipient[tx.recipient]
+        del self._seq[txid]
+        self._account(tx, -1)
+        self._index_bucket(txid, False)
+        if self.journal is not None:
+            self.journal.record_remove(txid)
+        return signed_tx
+
+    def _evict(self, txid: str) -> None:
+        """Evict ``txid``, then the spends that are no longer affordable without it (see ``_drop_unaffordable``)."""
+        signed_tx = self._pop(txid)
+        if signed_tx is None:
+            return
+        dependents = self._drop_unaffordable([signed_tx.transaction.recipient])
+        for evicted in [signed_tx] + dependents:
+            self._counters["evicted"] += 1
+            self._counters["evicted_bytes"] += estimate_size(evicted)
+        self._counters["evicted_dependent"] += len(dependents)
+        logger.debug(f"Evicted transactions from full mempool (size: {len(self._txs)}, bytes: {self._bytes})")
+
+    def _drop_unaffordable(self, accounts: Iterable[str]) -> List[SignedTransaction]:
+        """Remove the spends of ``accounts`` not covered at their place in the arrival order, then repeat for the
+        recipients of the removed spends, which lose a pending receipt."""
+        dropped: List[SignedTransaction] = []
+        queue = list(accounts)
+        while queue:
+            for txid in self._unaffordable_spends(queue.pop()):
+                signed_tx = self._pop(txid)
+                dropped.append(signed_tx)
+                queue.append(signed_tx.transaction.recipient)
+        return dropped
+
+    def _unaffordable_spends(self, account: str) -> List[str]:
+        """Replay the account's pending spends and receipts in arrival order from its confirmed balance, like block
+        validation would, and return the spends that would overdraw it (they are skipped in the replay)."""
+        spends = self._by_sender.get(account)
+        if not spends:
+            return []
+        receipts = self._by_recipient.get(account, ())
+        running = self.confirmed_balance(account)
+        unaffordable: List[str] = []
+        for txid in heapq.merge(spends, receipts, key=self._seq.__getitem__):
+            tx = self._txs[txid].transaction
+            if tx.sender == account:
+                if running < tx.amount:
+                    unaffordable.append(txid)
+                    continue
+                running -= tx.amount
+            if tx.recipient == account:
+                running += tx.amount
+        return unaffordable
+
+    def _index_bucket(self, txid: str, present: bool) -> None:
+        prefix = txid[:DIGEST_PREFIX_LEN]
+        bucket = self._buckets.setdefault(prefix, set())
+        if present:
+            bucket.add(txid)
+        else:
+            bucket.discard(txid)
+        value = self._bucket_xor.get(prefix, 0) ^ int(txid, 16)
+        if bucket:
+            self._bucket_xor[prefix] = value
+        else:
+            del self._buckets[prefix]
+            self._bucket_xor.pop(prefix, None)
+
+    def _account(self, tx: Transaction, sign: int) -> None:
+        self._adjust(self._spend, tx.sender, sign * tx.amount)
+        self._adjust(self._receive, tx.recipient, sign * tx.amount)
+
+    @staticmethod
+    def _adjust(totals: Dict[str, float], key: str, amount: float) -> None:
+        value = totals.get(key, 0.0) + amount
+        if abs(value) < 1e-9:
+            totals.pop(key, None)
+        else:
+            totals[key] = value
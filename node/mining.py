@@ -0,0 +1,227 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import queue
+import time
+from threading import Event, Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+NONCE_PLACEHOLDER = "__nonce__"
+STOP_CHECK_INTERVAL = 4096
+NONCE_RANGE_SIZE = 2 ** 32
+RESULT_POLL_INTERVAL = 0.05
+
+
+class PowTemplate:
+    """Block header serialized once around the nonce, with a SHA-256 midstate for the constant prefix.
+
+    The bytes hashed for a given nonce are identical to ``hash_dict(header)`` with that nonce,
+    so blocks produced here are accepted by ``Blockchain.validate_block``.
+    """
+
+    def __init__(self, header: Dict, difficulty: int):
+        fields = dict(header)
+        fields["nonce"] = NONCE_PLACEHOLDER
+        payload = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+
+        marker = '"nonce":' + json.dumps(NONCE_PLACEHOLDER)
+        if payload.count(marker) != 1:
+            raise ValueError("Cannot locate nonce in serialized header")
+        prefix, suffix = payload.split(marker)
+
+        self._setup((prefix + '"nonce":').encode("utf-8"), suffix.encode("utf-8"), difficulty)
+
+    def _setup(self, prefix: bytes, suffix: bytes, difficulty: int) -> None:
+        self.prefix = prefix
+        self.suffix = suffix
+        self.difficulty = max(0, int(difficulty))
+        self._zero_bytes = self.difficulty // 2
+        self._odd_nibble = self.difficulty % 2 == 1
+        self._midstate = hashlib.sha256(self.prefix)
+
+    def __getstate__(self) -> Tuple[bytes, bytes, int]:
+        return self.prefix, self.suffix, self.difficulty
+
+    def __setstate__(self, state: Tuple[bytes, bytes, int]) -> None:
+        self._setup(*state)
+
+    def _meets_target(self, digest: bytes) -> bool:
+        zero_bytes = self._zero_bytes
+        if digest[:zero_bytes] != b"\x00" * zero_bytes:
+            return False
+        return not self._odd_nibble or digest[zero_bytes] < 0x10
+
+    def hash_nonce(self, nonce: int) -> str:
+        h = self._midstate.copy()
+        h.update(b"%d" % nonce)
+        h.update(self.suffix)
+        return h.hexdigest()
+
+    def search(
+            self,
+            start: int = 0,
+            end: Optional[int] = None,
+            stop_event: Optional[Event] = None,
+            progress: Optional[Callable[[int], None]] = None,
+    ) -> Optional[Tuple[int, str]]:
+        midstate = self._midstate
+        suffix = self.suffix
+        meets_target = self._meets_target
+
+        nonce = start
+        while end is None or nonce < end:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            batch_end = nonce + STOP_CHECK_INTERVAL
+            if end is not None:
+                batch_end = min(batch_end, end)
+            for n in range(nonce, batch_end):
+                h = midstate.copy()
+                h.update(b"%d" % n)
+                h.update(suffix)
+                if meets_target(h.digest()):
+                    if progress is not None:
+                        progress(n - nonce + 1)
+                    return n, h.hexdigest()
+            if progress is not None:
+                progress(batch_end - nonce)
+            nonce = batch_end
+        return None
+
+
+class _JobCancelled:
+    def __init__(self, active_job, job_id: int):
+        self._active_job = active_job
+        self._job_id = job_id
+
+    def is_set(self) -> bool:
+        return self._active_job.value != self._job_id
+
+
+def _pool_worker(index: int, workers: int, jobs, results, active_job, hash_counts) -> None:
+    def count(n: int) -> None:
+        hash_counts[index] += n
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, template = job
+        cancelled = _JobCancelled(active_job, job_id)
+
+        chunk = index
+        while not cancelled.is_set():
+            start = chunk * NONCE_RANGE_SIZE
+            found = template.search(start, start + NONCE_RANGE_SIZE, stop_event=cancelled, progress=count)
+            if found is not None:
+                results.put((job_id, index, found[0], found[1]))
+                break
+            chunk += workers
+
+
+class MiningPool:
+    """Process pool searching disjoint nonce ranges of one PowTemplate; worker i scans ranges i, i+N, i+2N, ..."""
+
+    def __init__(self, workers: int):
+        if workers <= 0:
+            raise ValueError("Number of mining workers must be positive")
+        self.workers = workers
+
+        ctx = multiprocessing.get_context("spawn")
+        self._active_job = ctx.RawValue("q", 0)
+        self._hash_counts = ctx.RawArray("Q", workers)
+        self._results = ctx.Queue()
+        self._jobs = [ctx.Queue() for _ in range(workers)]
+        self._processes = [
+            ctx.Process(
+                target=_pool_worker,
+                args=(i, workers, self._jobs[i], self._results, self._active_job, self._hash_counts),
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        self._lock = Lock()
+        self._started = False
+        self._next_job_id = 1
+        self._job_started_at: Optional[float] = None
+        self._job_ended_at: Optional[float] = None
+        self._job_start_counts: List[int] = [0] * workers
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            for p in self._processes:
+                p.start()
+            self._started = True
+        logger.info(f"Mining pool started with {self.workers} worker processes")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if not self._started:
+                return
+            self._active_job.value = 0
+            for q in self._jobs:
+                q.put(None)
+            for p in self._processes:
+                p.join(timeout=2)
+                if p.is_alive():
+                    p.terminate()
+            self._started = False
+        logger.info("Mining pool stopped")
+
+    def search(self, template: PowTemplate, stop_event: Optional[Event] = None) -> Optional[Tuple[int, str]]:
+        self.start()
+        with self._lock:
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            self._job_start_counts = list(self._hash_counts)
+            self._job_started_at = time.time()
+            self._job_ended_at = None
+            self._active_job.value = job_id
+            for q in self._jobs:
+                q.put((job_id, template))
+
+        try:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                try:
+                    result_job, _, nonce, h = self._results.get(timeout=RESULT_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if result_job == job_id:
+                    return nonce, h
+        finally:
+            with self._lock:
+                if self._active_job.value == job_id:
+                    self._active_job.value = 0
+                self._job_ended_at = time.time()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = list(self._hash_counts)
+            start_counts = list(self._job_start_counts)
+            started_at = self._job_started_at
+            ended_at = self._job_ended_at
+
+        elapsed = 0.0
+        if started_at is not None:
+            elapsed = max(1e-9, (ended_at or time.time()) - started_at)
+
+        workers = []
+        for i, total in enumerate(counts):
+            job_hashes = total - start_counts[i]
+            workers.append({
+                "worker": i,
+                "hashes": total,
+                "hashrate": job_hashes / elapsed if elapsed else 0.0,
+            })
+        return {
+            "workers": workers,
+            "hashes": sum(counts),
+            "hashrate": sum(w["hashrate"] for w in workers),
+        }
@@ -1,21 +1,123 @@
 import logging
-from typing import Dict, List, Optional
+import queue
+import time
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+BROADCAST_TIMEOUT = 5
+CONNECT_TIMEOUT = 3
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.2
+
+
+def create_adapter(pool_size: int = HTTP_POOL_SIZE, retries: int = HTTP_RETRIES,
+                   backoff: float = HTTP_BACKOFF) -> HTTPAdapter:
+    """Keep-alive adapter with at most ``pool_size`` connections per host; connect errors are retried with backoff, reads only for GET."""
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=0,
+        backoff_factor=backoff,
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+
+def create_session(adapter: HTTPAdapter) -> requests.Session:
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def adapter_stats(adapter: HTTPAdapter) -> Dict:
+    """Requests and new connections of the adapter's live host pools; ``reused`` requests skipped the TCP handshake."""
+    requests_sent = 0
+    connections = 0
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        requests_sent += pool.num_requests
+        connections += pool.num_connections
+    return {
+        "requests": requests_sent,
+        "connections": connections,
+        "reused": max(0, requests_sent - connections),
+    }
+
+
+def compact_block(block: Dict) -> Dict:
+    """Header, coinbase and txids of a block dict; the receiver rebuilds the rest from its mempool."""
+    txs = block.get("txs") or []
+    compact = {k: v for k, v in block.items() if k != "txs"}
+    compact["coinbase"] = txs[0] if txs else None
+    compact["txids"] = [tx["txid"] for tx in txs]
+    return compact
+
 
 class NetworkClient:
-    def __init__(self, timeout: int = 10):
+    """HTTP client for peers and the graph manager.
+
+    ``requests.Session`` is not thread-safe, so each request checks a session out of an idle pool and returns it
+    afterwards. All sessions share one adapter, whose connection pools are thread-safe, so ``pool_size`` bounds the
+    connections per host however many requests run at once; requests beyond it wait for a free connection.
+    """
+
+    def __init__(self, timeout: int = 10, broadcast_timeout: float = BROADCAST_TIMEOUT,
+                 connect_timeout: float = CONNECT_TIMEOUT, pool_size: int = HTTP_POOL_SIZE,
+                 retries: int = HTTP_RETRIES, backoff: float = HTTP_BACKOFF):
         self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.broadcast_timeout = broadcast_timeout
+        self._adapter = create_adapter(pool_size, retries, backoff)
+        self._idle_sessions: "queue.LifoQueue[requests.Session]" = queue.LifoQueue()
+        self._session_count = 0
+        self._peer_stats: Dict[str, Dict] = {}
+        self._stats_lock = Lock()
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        try:
+            session = self._idle_sessions.get_nowait()
+        except queue.Empty:
+            session = create_session(self._adapter)
+            with self._stats_lock:
+                self._session_count += 1
+        try:
+            return session.request(method, url, **kwargs)
+        finally:
+            self._idle_sessions.put(session)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self._request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self._request("POST", url, **kwargs)
+
+    def _timeout(self, read_timeout: Optional[float] = None) -> Tuple[float, float]:
+        return self.connect_timeout, read_timeout or self.timeout
+
+    def connection_stats(self) -> Dict:
+        with self._stats_lock:
+            sessions = self._session_count
+        return {"sessions": sessions, **adapter_stats(self._adapter)}
 
     def register_as_inbound_peer(self, peer_host: str, peer_port: int, own_host: str, own_port: int) -> bool:
         url = f"http://{peer_host}:{peer_port}/peers"
         payload = {"host": own_host, "port": own_port}
 
         try:
-            response = requests.post(url, json=payload, timeout=self.timeout)
+            response = self.post(url, json=payload, timeout=self._timeout())
             if response.status_code == 201:
                 logger.info(f"Successfully registered as inbound peer for {peer_host}:{peer_port}")
                 return True
@@ -30,7 +132,7 @@ class NetworkClient:
     def fetch_peers_from_peer(self, peer_host: str, peer_port: int) -> Optional[List[Dict]]:
         try:
             url = f"http://{peer_host}:{peer_port}/peers"
-            response = requests.get(url, timeout=self.timeout)
+            response = self.get(url, timeout=self._timeout())
             if response.status_code == 200:
                 peers = response.json()
                 logger.info(f"Fetched {len(peers)} peers from {peer_host}:{peer_port}")
@@ -45,58 +147,192 @@ class NetworkClient:
     def ping_peer(self, peer_host: str, peer_port: int) -> bool:
         url = f"http://{peer_host}:{peer_port}/ping"
         try:
-            response = requests.get(url, timeout=self.timeout)
+            response = self.get(url, timeout=self._timeout())
             return response.status_code == 200
         except requests.ConnectionError:
             logger.warning(f"Peer {peer_host}:{peer_port} is unreachable")
             return False
 
-    def submit_block_to_peer(self, peer_host: str, peer_port: int, block: Dict) -> bool:
+    def submit_block_to_peer(self, peer_host: str, peer_port: int, block: Dict,
+                             timeout: Optional[float] = None) -> bool:
+        """POST a block as a compact block when it has a merkle root; missing txs are sent in a follow-up call.
+
+        Like the other ``submit_*`` methods it raises ``requests.RequestException`` on transport failures,
+        which ``deliver`` records as a timeout or error rather than a rejection.
+        """
         url = f"http://{peer_host}:{peer_port}/blocks"
         try:
-            r = requests.post(url, json=block, timeout=self.timeout)
+            payload = compact_block(block) if block.get("merkle_root") else block
+            r = self.post(url, json=payload, timeout=self._timeout(timeout))
+            if r.status_code == 200 and r.json().get("status") == "missing":
+                missing = set(r.json().get("missing") or [])
+                payload = dict(payload, missing_txs=[tx for tx in block["txs"] if tx["txid"] in missing])
+                logger.info(f"Peer {peer_host}:{peer_port} requested {len(missing)} txs of block h={block.get('height')}")
+                r = self.post(url, json=payload, timeout=self._timeout(timeout))
+                if r.status_code == 200 and r.json().get("status") == "missing":
+                    logger.warning(f"Peer {peer_host}:{peer_port} still misses txs of block h={block.get('height')} "
+                                   f"after the follow-up")
+                    with self._stats_lock:
+                        self._peer_counters(f"{peer_host}:{peer_port}")["compact_unresolved"] += 1
+                    return False
             if r.status_code in (200, 201):
                 logger.info(f"Submitted block h={block.get('height')} to {peer_host}:{peer_port}")
                 return True
             logger.warning(f"Peer {peer_host}:{peer_port} rejected block: {r.status_code} {r.text}")
             return False
-        except Exception as e:
+        except (KeyError, TypeError, ValueError) as e:
             logger.warning(f"Peer {peer_host}:{peer_port} failed: {e}")
             return False
 
-    def broadcast_block(self, peers: List[Dict], block: Dict):
-        ok = 0
-        for p in peers:
-            if self.submit_block_to_peer(p['host'], int(p['port']), block):
-                ok += 1
-        logger.info(f"Broadcasted block h={block.get('height')} to {ok}/{len(peers)} peers")
-
-    def submit_transaction_to_peer(self, peer_host: str, peer_port: int, transaction: Dict) -> bool:
+    def submit_transaction_to_peer(self, peer_host: str, peer_port: int, transaction: Dict,
+                                   timeout: Optional[float] = None) -> bool:
+        """POST one transaction; raises ``requests.RequestException`` on transport failures (see ``deliver``)."""
         url = f"http://{peer_host}:{peer_port}/transactions"
+        r = self.post(url, json=transaction, timeout=self._timeout(timeout))
+        if r.status_code in (200, 201):
+            logger.info(f"Submitted tx {transaction['txid'][:16]}... to {peer_host}:{peer_port}")
+            return True
+        logger.warning(f"Peer {peer_host}:{peer_port} rejected transaction: {r.status_code}")
+        return False
+
+    def submit_transactions_to_peer(self, peer_host: str, peer_port: int, transactions: List[Dict],
+                                    timeout: Optional[float] = None) -> bool:
+        """POST a batch to /transactions/batch; raises ``requests.RequestException`` on transport failures."""
+        url = f"http://{peer_host}:{peer_port}/transactions/batch"
+        r = self.post(url, json=transactions, timeout=self._timeout(timeout))
+        if r.status_code == 200:
+            accepted = r.json().get("accepted", 0)
+            logger.info(f"Submitted {len(transactions)} txs to {peer_host}:{peer_port} ({accepted} accepted)")
+            return True
+        logger.warning(f"Peer {peer_host}:{peer_port} rejected transaction batch: {r.status_code}")
+        return False
+
+    def _send(self, submit: Callable[..., bool], host: str, port: int, payload) -> Dict:
+        started = time.monotonic()
         try:
-            r = requests.post(url, json=transaction, timeout=self.timeout)
-            if r.status_code in (200, 201):
-                logger.info(f"Submitted tx {transaction['txid'][:16]}... to {peer_host}:{peer_port}")
-                return True
-            logger.warning(f"Peer {peer_host}:{peer_port} rejected transaction: {r.status_code}")
-            return False
+            outcome = "ok" if submit(host, port, payload, timeout=self.broadcast_timeout) else "rejected"
+        except requests.Timeout:
+            outcome = "timeout"
         except requests.ConnectionError:
-            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for transaction submit")
-            return False
+            logger.warning(f"Peer {host}:{port} is unreachable")
+            outcome = "error"
+        except requests.RequestException as e:
+            logger.warning(f"Peer {host}:{port} failed: {e}")
+            outcome = "error"
+        return {"peer": f"{host}:{port}", "ok": outcome == "ok", "outcome": outcome,
+                "latency": time.monotonic() - started}
+
+    def deliver(self, peer_host: str, peer_port: int, kind: str, payload) -> Dict:
+        """Send one ``"block"``, ``"tx"`` or ``"txs"`` (list) message to a single peer and record its outcome.
+
+        Transport failures raised by the ``submit_*`` methods are classified here as ``timeout`` or ``error``.
+        """
+        submit = {
+            "block": self.submit_block_to_peer,
+            "tx": self.submit_transaction_to_peer,
+            "txs": self.submit_transactions_to_peer,
+        }[kind]
+        result = self._send(submit, peer_host, peer_port, payload)
+        self._record_broadcast([result])
+        return result
+
+    def _peer_counters(self, peer: str) -> Dict:
+        """Stats entry of ``peer``; the caller holds ``_stats_lock``."""
+        return self._peer_stats.setdefault(peer, {
+            "sent": 0, "ok": 0, "rejected": 0, "timeout": 0, "error": 0, "compact_unresolved": 0,
+            "last_latency": None, "avg_latency": None,
+        })
+
+    def _record_broadcast(self, results: List[Dict]) -> None:
+        with self._stats_lock:
+            for r in results:
+                stats = self._peer_counters(r["peer"])
+                stats["sent"] += 1
+                stats[r["outcome"]] += 1
+                if r["latency"] is not None:
+                    stats["last_latency"] = r["latency"]
+                    previous = stats["avg_latency"]
+                    stats["avg_latency"] = r["latency"] if previous is None else 0.8 * previous + 0.2 * r["latency"]
+
+    def broadcast_stats(self) -> Dict[str, Dict]:
+        with self._stats_lock:
+            return {peer: dict(stats) for peer, stats in self._peer_stats.items()}
 
-    def broadcast_transaction(self, peers: List[Dict], transaction: Dict):
-        ok = 0
-        for p in peers:
-            if self.submit_transaction_to_peer(p['host'], int(p['port']), transaction):
-                ok += 1
-        logger.info(f"Broadcasted transaction to {ok}/{len(peers)} peers")
+    def fetch_mempool_digest(self, peer_host: str, peer_port: int) -> Optional[Dict[str, Dict]]:
+        """GET /transactions/digest; returns the peer's per-bucket ``{"count", "xor"}`` summary of its mempool."""
+        url = f"http://{peer_host}:{peer_port}/transactions/digest"
+        try:
+            r = self.get(url, timeout=self._timeout())
+            if r.status_code != 200:
+                logger.warning(f"Failed to fetch mempool digest from {peer_host}:{peer_port}: {r.status_code}")
+                return None
+            data = r.json()
+            buckets = data.get("buckets") if isinstance(data, dict) else None
+            if not isinstance(buckets, dict):
+                logger.warning(f"Invalid /transactions/digest response format from {peer_host}:{peer_port}")
+                return None
+            return buckets
+        except requests.RequestException as e:
+            logger.warning(f"Peer {peer_host}:{peer_port} failed mempool digest fetch: {e}")
+            return None
 
-    def fetch_chain_from_peer(self, peer_host: str, peer_port: int) -> Optional[List[Dict]]:
+    def fetch_digest_buckets(self, peer_host: str, peer_port: int, prefixes: List[str]) -> Optional[Dict[str, List[str]]]:
+        """POST /transactions/digest; returns the peer's txids in the given buckets."""
+        url = f"http://{peer_host}:{peer_port}/transactions/digest"
+        try:
+            r = self.post(url, json={"buckets": prefixes}, timeout=self._timeout())
+            if r.status_code != 200:
+                logger.warning(f"Failed to fetch digest buckets from {peer_host}:{peer_port}: {r.status_code}")
+                return None
+            data = r.json()
+            txids = data.get("txids") if isinstance(data, dict) else None
+            if not isinstance(txids, dict):
+                logger.warning(f"Invalid /transactions/digest response format from {peer_host}:{peer_port}")
+                return None
+            return {str(prefix): [str(t) for t in ids or []] for prefix, ids in txids.items()}
+        except requests.RequestException as e:
+            logger.warning(f"Peer {peer_host}:{peer_port} failed digest buckets fetch: {e}")
+            return None
+
+    def fetch_transactions_by_id(self, peer_host: str, peer_port: int, txids: List[str]) -> Optional[List[Dict]]:
+        """POST /transactions/fetch; returns the requested transactions the peer still holds."""
+        url = f"http://{peer_host}:{peer_port}/transactions/fetch"
+        try:
+            r = self.post(url, json={"txids": txids}, timeout=self._timeout())
+            if r.status_code != 200:
+                logger.warning(f"Failed to fetch transactions from {peer_host}:{peer_port}: {r.status_code}")
+                return None
+            data = r.json()
+            if not isinstance(data, list):
+                logger.warning(f"Invalid /transactions/fetch response format from {peer_host}:{peer_port}")
+                return None
+            return data
+        except requests.RequestException as e:
+            logger.warning(f"Peer {peer_host}:{peer_port} failed transactions fetch: {e}")
+            return None
+
+    def fetch_tip(self, peer_host: str, peer_port: int) -> Optional[Dict]:
+        url = f"http://{peer_host}:{peer_port}/tip"
+        try:
+            r = self.get(url, timeout=self._timeout())
+            if r.status_code != 200:
+                logger.warning(f"Failed to fetch tip from {peer_host}:{peer_port}: {r.status_code}")
+                return None
+            data = r.json()
+            if not isinstance(data, dict) or "height" not in data or "work" not in data:
+                logger.warning(f"Invalid /tip response format from {peer_host}:{peer_port}")
+                return None
+            return data
+        except requests.ConnectionError:
+            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for tip fetch")
+            return None
+
+    def fetch_blocks_from_peer(self, peer_host: str, peer_port: int, from_height: int, limit: int) -> Optional[List[Dict]]:
         url = f"http://{peer_host}:{peer_port}/blocks"
         try:
-            r = requests.get(url, timeout=self.timeout)
+            r = self.get(url, params={"from": from_height, "limit": limit}, timeout=self._timeout())
             if r.status_code != 200:
-                logger.warning(f"Failed to fetch chain from {peer_host}:{peer_port}: {r.status_code}")
+                logger.warning(f"Failed to fetch blocks from {peer_host}:{peer_port}: {r.status_code}")
                 return None
             data = r.json()
             if not isinstance(data, list):
@@ -104,22 +340,59 @@ class NetworkClient:
                 return None
             return data
         except requests.ConnectionError:
-            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for chain fetch")
+            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for blocks fetch")
             return None
 
-    def fetch_pending_transactions_from_peer(self, peer_host: str, peer_port: int) -> Optional[List[Dict]]:
-        url = f"http://{peer_host}:{peer_port}/transactions"
+    def fetch_headers_from_peer(self, peer_host: str, peer_port: int, from_height: int, limit: int) -> Optional[List[Dict]]:
+        url = f"http://{peer_host}:{peer_port}/headers"
         try:
-            r = requests.get(url, timeout=self.timeout)
+            r = self.get(url, params={"from": from_height, "limit": limit}, timeout=self._timeout())
             if r.status_code != 200:
-                logger.warning(f"Failed to fetch transactions from {peer_host}:{peer_port}: {r.status_code}")
+                logger.warning(f"Failed to fetch headers from {peer_host}:{peer_port}: {r.status_code}")
                 return None
             data = r.json()
             if not isinstance(data, list):
-                logger.warning(f"Invalid /transactions response format from {peer_host}:{peer_port}")
+                logger.warning(f"Invalid /headers response format from {peer_host}:{peer_port}")
+                return None
+            return data
+        except requests.ConnectionError:
+            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for headers fetch")
+            return None
+
+    def locate_on_peer(self, peer_host: str, peer_port: int, locator: List[str], limit: int,
+                       headers_only: bool = True) -> Optional[Dict]:
+        url = f"http://{peer_host}:{peer_port}/locate"
+        payload = {"locator": locator, "limit": limit, "headers_only": headers_only}
+        try:
+            r = self.post(url, json=payload, timeout=self._timeout())
+            if r.status_code != 200:
+                logger.warning(f"Failed to locate fork point with {peer_host}:{peer_port}: {r.status_code}")
+                return None
+            data = r.json()
+            if not isinstance(data, dict) or not isinstance(data.get("ancestor"), dict):
+                logger.warning(f"Invalid /locate response format from {peer_host}:{peer_port}")
                 return None
-            logger.info(f"Fetched {len(data)} pending transactions from {peer_host}:{peer_port}")
             return data
         except requests.ConnectionError:
-            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for transactions fetch")
+            logger.warning(f"Peer {peer_host}:{peer_port} is unreachable for locate")
+            return None
+
+    def announce_inventory(self, peer_host: str, peer_port: int, origin: Dict, blocks: List[str],
+                           txs: List[str]) -> Optional[Dict]:
+        """POST block hashes and txids to /inv; returns the ``getdata`` lists of objects the peer is missing."""
+        url = f"http://{peer_host}:{peer_port}/inv"
+        payload = {"from": origin, "blocks": blocks, "txs": txs}
+        try:
+            r = self.post(url, json=payload, timeout=self._timeout(self.broadcast_timeout))
+            if r.status_code != 200:
+                logger.warning(f"Failed to announce inventory to {peer_host}:{peer_port}: {r.status_code}")
+                return None
+            data = r.json()
+            getdata = data.get("getdata") if isinstance(data, dict) else None
+            if not isinstance(getdata, dict):
+                logger.warning(f"Invalid /inv response format from {peer_host}:{peer_port}")
+                return None
+            return {"blocks": list(getdata.get("blocks") or []), "txs": list(getdata.get("txs") or [])}
+        except requests.RequestException as e:
+            logger.warning(f"Peer {peer_host}:{peer_port} failed inventory announce: {e}")
             return None
@@ -0,0 +1,178 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .network import NetworkClient
+
+logger = logging.getLogger(__name__)
+
+RELAY_QUEUE_DEPTH = 1000
+RECENTLY_SEEN_SIZE = 5000
+INV_BATCH_SIZE = 500
+TX_BATCH_WINDOW = 0.05
+
+INV_KINDS = {"block": "blocks", "tx": "txs"}
+
+
+class OutboundRelay:
+    """Per-peer outbound queues drained by background sender threads.
+
+    Request handlers only enqueue, so they return as soon as local validation and storage are done.
+    A message already waiting in a peer's queue is not queued twice; a full queue drops new messages.
+    Messages to one peer are sent in order (a parent block is always sent before its child).
+
+    Queued objects are first announced by hash (POST /inv) and only the ones the peer asks for are sent.
+    A bounded per-peer "recently seen" set remembers what each peer already has or announced to us,
+    so those objects are not announced to it again.
+
+    Transactions wait up to ``tx_batch_window`` seconds so a burst is announced together, and
+    consecutive requested transactions go out as one POST /transactions/batch.
+    """
+
+    def __init__(self, network: NetworkClient, origin: Optional[Dict] = None, max_depth: int = RELAY_QUEUE_DEPTH,
+                 recently_seen_size: int = RECENTLY_SEEN_SIZE, tx_batch_window: float = TX_BATCH_WINDOW):
+        self.network = network
+        self.tx_batch_window = tx_batch_window
+        self.origin = origin or {}
+        self.max_depth = max_depth
+        self.recently_seen_size = recently_seen_size
+        self._queues: Dict[Tuple[str, int], "OrderedDict[Tuple[str, str], Dict]"] = {}
+        self._seen: Dict[Tuple[str, int], "OrderedDict[Tuple[str, str], None]"] = {}
+        self._senders: Dict[Tuple[str, int], Thread] = {}
+        self._stats: Dict[Tuple[str, int], Dict[str, int]] = {}
+        self._lock = Lock()
+        self._stopped = False
+
+    def broadcast_block(self, peers: List[Dict], block: Dict) -> None:
+        self.enqueue(peers, "block", str(block["hash"]), block)
+
+    def broadcast_transaction(self, peers: List[Dict], transaction: Dict) -> None:
+        self.enqueue(peers, "tx", str(transaction["txid"]), transaction)
+
+    def enqueue(self, peers: List[Dict], kind: str, key: str, payload: Dict) -> None:
+        with self._lock:
+            if self._stopped:
+                return
+            for p in peers:
+                peer = (p['host'], int(p['port']))
+                queue = self._queues.setdefault(peer, OrderedDict())
+                stats = self._peer_stats(peer)
+                if (kind, key) in self._seen.get(peer, ()):
+                    stats["known"] += 1
+                    continue
+                if (kind, key) in queue:
+                    stats["deduplicated"] += 1
+                    continue
+                if len(queue) >= self.max_depth:
+                    stats["dropped"] += 1
+                    logger.warning(f"Relay queue for {peer[0]}:{peer[1]} is full; dropped {kind} {key[:16]}...")
+                    continue
+                queue[(kind, key)] = payload
+                stats["enqueued"] += 1
+                stats["max_depth_seen"] = max(stats["max_depth_seen"], len(queue))
+                if peer not in self._senders:
+                    sender = Thread(target=self._drain, args=(peer,), daemon=True,
+                                    name=f"relay-{peer[0]}:{peer[1]}")
+                    self._senders[peer] = sender
+                    sender.start()
+
+    def mark_seen(self, peer_host: str, peer_port: int, kind: str, keys: Iterable[str]) -> None:
+        """Record that the peer already has these objects (it announced or received them)."""
+        with self._lock:
+            self._mark_seen((peer_host, int(peer_port)), kind, keys)
+
+    def _mark_seen(self, peer: Tuple[str, int], kind: str, keys: Iterable[str]) -> None:
+        seen = self._seen.setdefault(peer, OrderedDict())
+        for key in keys:
+            seen[(kind, key)] = None
+            seen.move_to_end((kind, key))
+        while len(seen) > self.recently_seen_size:
+            seen.popitem(last=False)
+
+    def _peer_stats(self, peer: Tuple[str, int]) -> Dict[str, int]:
+        return self._stats.setdefault(peer, {
+            "enqueued": 0, "announced": 0, "requested": 0, "sent": 0, "failed": 0,
+            "known": 0, "deduplicated": 0, "dropped": 0, "max_depth_seen": 0,
+        })
+
+    def _drain(self, peer: Tuple[str, int]) -> None:
+        while True:
+            with self._lock:
+                queue = self._queues.get(peer)
+                head_is_tx = bool(queue) and next(iter(queue))[0] == "tx"
+            if head_is_tx and self.tx_batch_window > 0:
+                time.sleep(self.tx_batch_window)
+
+            with self._lock:
+                queue = self._queues.get(peer)
+                if self._stopped or not queue:
+                    self._senders.pop(peer, None)
+                    return
+                batch = []
+                while queue and len(batch) < INV_BATCH_SIZE:
+                    batch.append(queue.popitem(last=False))
+
+            inventory = {"blocks": [], "txs": []}
+            for (kind, key), _ in batch:
+                inventory[INV_KINDS[kind]].append(key)
+            wanted = self.network.announce_inventory(peer[0], peer[1], self.origin,
+                                                     inventory["blocks"], inventory["txs"])
+            seen = []
+            if wanted is not None:
+                requested = {(kind, key) for kind, field in INV_KINDS.items() for key in wanted[field]}
+                seen = [item[0] for item in batch if item[0] not in requested]
+                batch = [item for item in batch if item[0] in requested]
+
+            sent = failed = 0
+            for kind, items in self._group_transactions(batch):
+                payload = [p for _, p in items] if kind == "txs" else items[0][1]
+                if self.network.deliver(peer[0], peer[1], kind, payload)["ok"]:
+                    seen.extend(item for item, _ in items)
+                    sent += len(items)
+                else:
+                    failed += len(items)
+
+            with self._lock:
+                for kind, key in seen:
+                    self._mark_seen(peer, kind, [key])
+                stats = self._peer_stats(peer)
+                stats["announced"] += sum(len(keys) for keys in inventory.values())
+                stats["requested"] += len(batch)
+                stats["sent"] += sent
+                stats["failed"] += failed
+
+    @staticmethod
+    def _group_transactions(batch: List[Tuple[Tuple[str, str], Dict]]) -> List[Tuple[str, List]]:
+        """Split into single blocks and runs of consecutive transactions, keeping the queue order."""
+        groups: List[Tuple[str, List]] = []
+        for item in batch:
+            if item[0][0] == "tx":
+                if groups and groups[-1][0] == "txs":
+                    groups[-1][1].append(item)
+                else:
+                    groups.append(("txs", [item]))
+            else:
+                groups.append((item[0][0], [item]))
+        return [("tx", items) if kind == "txs" and len(items) == 1 else (kind, items) for kind, items in groups]
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped = True
+            self._queues.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            peers = {
+                f"{host}:{port}": dict(stats, depth=len(self._queues.get((host, port), ())))
+                for (host, port), stats in self._stats.items()
+            }
+        return {
+            "max_depth": self.max_depth,
+            "depth": sum(p["depth"] for p in peers.values()),
+            "dropped": sum(p["dropped"] for p in peers.values()),
+            "deduplicated": sum(p["deduplicated"] for p in peers.values()),
+            "known": sum(p["known"] for p in peers.values()),
+            "peers": peers,
+        }
@@ -3,7 +3,7 @@ import os
 import random
 import re
 import time
-from threading import Event, Thread
+from threading import Event, Lock, RLock, Thread
 from typing import Dict, List, Optional, Set, Tuple
 
 import requests
@@ -11,14 +11,29 @@ from flask import Flask, jsonify, request
 from flask_cors import CORS
 
 from node.blockchain import (
-    MINING_MIN,
+    UNDO_DEPTH,
     Block,
     Blockchain,
-    calculate_balance_with_mempool,
+    ChainState,
+    block_locator,
+    block_work,
+    deserialize_chain,
+    header_work,
 )
-from node.network import NetworkClient
-from node.storage import ChainStorage, PeerStorage
-from node.transactions import SignedTransaction
+from node.mempool import MEMPOOL_MAX_BYTES, MEMPOOL_MAX_PER_SENDER, MEMPOOL_MAX_TXS, Mempool
+from node.mining import MiningPool
+from node.network import HTTP_POOL_SIZE, HTTP_RETRIES, NetworkClient
+from node.relay import TX_BATCH_WINDOW, OutboundRelay
+from node.storage import ChainStorage, MempoolStorage, PeerStorage
+from node.template import BLOCK_MAX_BYTES, BLOCK_MAX_TXS, BlockTemplate
+from node.transactions import (
+    SignedTransaction,
+    Transaction,
+    configure_verification_pool,
+    signature_cache,
+    verify_signatures_batch,
+)
+from node.utils import merkle_leaf, merkle_root
 
 logger = logging.getLogger(__name__)
 
@@ -26,11 +41,22 @@ MAX_PEERS = 5
 MAX_BOOTSTRAP_PEERS = 3
 DIFFICULTY = 5
 ORPHAN_MAX_DEPTH = 6
+SIDE_BLOCK_PRUNE_INTERVAL = 50
+BLOCKS_PAGE_LIMIT = 500
+HEADERS_PAGE_LIMIT = 2000
+SYNC_PAGE_SIZE = 100
+TX_BATCH_LIMIT = 1000
+MEMPOOL_FLUSH_INTERVAL = 1.0
+MEMPOOL_SYNC_INTERVAL = 30.0
 
 
 class NodeServer:
     def __init__(self, host: str, port: int, seed_peers: list, *, role: str = "normal", public_key: str,
-                 centralized_manager_url: Optional[str] = None):
+                 centralized_manager_url: Optional[str] = None, mining_workers: int = 1, verify_workers: int = 1,
+                 http_pool_size: int = HTTP_POOL_SIZE, http_retries: int = HTTP_RETRIES,
+                 tx_relay_window: float = TX_BATCH_WINDOW, mempool_max_txs: int = MEMPOOL_MAX_TXS,
+                 mempool_max_bytes: int = MEMPOOL_MAX_BYTES, mempool_max_per_sender: int = MEMPOOL_MAX_PER_SENDER,
+                 block_max_txs: int = BLOCK_MAX_TXS, block_max_bytes: int = BLOCK_MAX_BYTES):
         self.host = host
         self.port = port
         self.public_key = public_key
@@ -41,25 +67,47 @@ class NodeServer:
 
         peers_db_path = os.path.join(db_dir, f'peers_{port}.db')
         chain_db_path = os.path.join(db_dir, f'chain_{port}.db')
+        mempool_db_path = os.path.join(db_dir, f'mempool_{port}.db')
+
+        configure_verification_pool(verify_workers)
 
         self.storage = PeerStorage(peers_db_path)
-        self.network = NetworkClient()
+        self.network = NetworkClient(pool_size=http_pool_size, retries=http_retries)
+        self.relay = OutboundRelay(self.network, origin={"host": host, "port": port}, tx_batch_window=tx_relay_window)
         self.seed_peers = seed_peers
         self.role = role
         self.blockchain = Blockchain(DIFFICULTY)
         self.chain_storage = ChainStorage(chain_db_path)
-        self.pending_transactions: list[SignedTransaction] = []
+        self.chain_state = ChainState(self.blockchain)
+        self.chain: List[Block] = []
+        self.height_by_hash: Dict[str, int] = {}
+        self.chain_lock = RLock()
+        self.mempool_storage = MempoolStorage(mempool_db_path)
+        self.mempool = Mempool(
+            lambda public_key: self.chain_state.balance_of(public_key),
+            max_txs=mempool_max_txs,
+            max_bytes=mempool_max_bytes,
+            max_per_sender=mempool_max_per_sender,
+            journal=self.mempool_storage,
+        )
+        self.block_template = BlockTemplate(self.mempool, max_txs=block_max_txs, max_bytes=block_max_bytes)
         self.centralized_manager_url = centralized_manager_url
         self.app = Flask(__name__, static_folder='../static', static_url_path='/static')
         CORS(self.app, resources={
             "/*": {"origins": [re.compile(r"^http://127.0.0.1:\d+$")]}
         })
 
+        self.compact_stats = {"received": 0, "reconstructed_from_mempool": 0, "missing_requests": 0, "missing_txs": 0}
+        self.compact_lock = Lock()
+        self.mempool_sync_stats = {"rounds": 0, "failed": 0, "buckets_differing": 0, "txs_received": 0, "txs_pushed": 0}
+        self.mempool_sync_lock = Lock()
         self.orphans_by_prev: Dict[str, List[Block]] = {}
+        self._side_blocks_pruned_below = 0
         self.known_hashes: Set[str] = set()
 
         self._setup_routes()
         self._init_chain()
+        Thread(target=self._mempool_flush_worker, daemon=True).start()
 
         if self.centralized_manager_url:
             Thread(target=self._register_with_centralized_manager, daemon=True).start()
@@ -67,30 +115,32 @@ class NodeServer:
         self.mining_enabled: bool = False
         self.mining_thread: Optional[Thread] = None
         self.mining_stop_event: Event = Event()
+        self.mining_workers = max(1, int(mining_workers))
+        self.mining_pool: Optional[MiningPool] = None
 
     def _mining_worker(self):
         logger.info("Mining thread started")
         while self.mining_enabled:
             try:
                 self.mining_stop_event.clear()
-                last_d = self.chain_storage.get_last_block()
-                prev = Block.from_dict(last_d) if last_d else self.blockchain.create_genesis()
-
-                txs_snapshot = list(self.pending_transactions)
+                prev = self.chain_state.tip or self.blockchain.create_genesis()
 
                 new_block = self.blockchain.mine_next_block(
                     prev,
                     self.public_key,
-                    txs=txs_snapshot,
-                    stop_event=self.mining_stop_event
+                    self.block_template,
+                    stop_event=self.block_template.stale_signal(self.mining_stop_event),
+                    pool=self.mining_pool
                 )
 
                 if not self.mining_enabled:
                     break
                 if new_block is None:
                     continue
+                if not self._connect_block(new_block):
+                    self._discard_mined_block(new_block)
+                    continue
 
-                self.chain_storage.save_block(new_block.to_dict())
                 self.remove_transactions_from_mempool(new_block)
 
                 self.known_hashes.add(new_block.hash)
@@ -98,7 +148,7 @@ class NodeServer:
                 self._prune_orphans()
 
                 peers = self.storage.get_all_peers()
-                self.network.broadcast_block(peers, new_block.to_dict())
+                self.relay.broadcast_block(peers, new_block.to_dict())
 
                 self._notify_centralized_manager()
                 logger.info(f"Mined new block h={new_block.height} hash={new_block.hash[:16]}...")
@@ -111,6 +161,23 @@ class NodeServer:
                 time.sleep(0.5)
         logger.info("Mining thread stopped")
 
+    def _discard_mined_block(self, block: Block) -> None:
+        """Handle a mined block that failed to connect; if it was built on the current tip, its body was invalid,
+        so the transactions that caused it are dropped from the mempool instead of being mined again."""
+        tip = self.chain_state.tip
+        if tip is not None and block.prev_hash != tip.hash:
+            logger.info(f"Discarding stale mined block h={block.height}; tip moved while mining")
+            return
+        unaffordable = self.chain_state.unaffordable_transactions(block.txs[1:])
+        if not unaffordable:
+            logger.error(f"Mined block h={block.height} failed validation on the current tip")
+            return
+        removed = self.mempool.remove(signed_tx.transaction.txid for signed_tx in unaffordable)
+        dropped = self.mempool.recheck({signed_tx.transaction.recipient for signed_tx in removed})
+        self.block_template.refresh()
+        logger.warning(f"Mined block h={block.height} was invalid on the current tip; dropped "
+                       f"{len(removed) + len(dropped)} unaffordable transactions from the mempool")
+
     def _interrupt_mining(self):
         if hasattr(self, 'mining_stop_event') and self.mining_stop_event is not None:
             self.mining_stop_event.set()
@@ -121,6 +188,8 @@ class NodeServer:
             return False
         if self.mining_enabled and self.mining_thread and self.mining_thread.is_alive():
             return True
+        if self.mining_pool is None:
+            self.mining_pool = MiningPool(self.mining_workers)
         self.mining_enabled = True
         self.mining_thread = Thread(target=self._mining_worker, daemon=True)
         self.mining_thread.start()
@@ -136,6 +205,9 @@ class NodeServer:
                 self.mining_thread.join(timeout=2)
         except Exception:
             pass
+        if self.mining_pool is not None:
+            self.mining_pool.shutdown()
+            self.mining_pool = None
         return True
 
     def _register_with_centralized_manager(self):
@@ -144,7 +216,7 @@ class NodeServer:
         retry_delay = 0.5
         for attempt in range(max_retries):
             try:
-                response = requests.post(
+                response = self.network.post(
                     f"{self.centralized_manager_url}/register-node",
                     json={"host": self.host, "port": self.port},
                     timeout=10
@@ -171,7 +243,7 @@ class NodeServer:
     def _notify_centralized_manager(self):
         if self.centralized_manager_url:
             try:
-                requests.post(
+                self.network.post(
                     f"{self.centralized_manager_url}/notify",
                     timeout=1
                 )
@@ -180,55 +252,133 @@ class NodeServer:
 
     def _init_chain(self):
         local_chain = self.chain_storage.load_chain()
-        local_len = len(local_chain)
-
-        best_chain = None
-        best_peer_host = None
-        best_peer_port = None
-
-        if self.seed_peers:
-            for seed in self.seed_peers:
-                host, port = seed.get('host'), int(seed.get('port'))
-                chain_dicts = self.network.fetch_chain_from_peer(host, port)
-                if chain_dicts:
-                    chain = [Block.from_dict(b) for b in chain_dicts]
-                    if best_chain is None or len(chain) > len(best_chain):
-                        best_chain = chain
-                        best_peer_host = host
-                        best_peer_port = port
-
-        adopted = False
-        if best_chain and len(best_chain) > local_len:
-            if self.blockchain.validate_chain(best_chain):
-                self.chain_storage.replace_chain(best_chain)
-                for block in best_chain:
-                    self.remove_transactions_from_mempool(block)
-                logger.info(f"Adopted longer chain from seed: {len(best_chain)} blocks (local had {local_len})")
-                adopted = True
-
-                if best_peer_host and best_peer_port:
-                    tx_dicts = self.network.fetch_pending_transactions_from_peer(best_peer_host, best_peer_port)
-                    if tx_dicts:
-                        for tx_dict in tx_dicts:
-                            try:
-                                signed_tx = SignedTransaction.from_dict(tx_dict)
-                                self.add_transaction(signed_tx)
-                            except Exception as e:
-                                logger.warning(f"Failed to add transaction from peer mempool: {e}")
-                        logger.info(f"Synchronized {len(self.pending_transactions)} transactions from peer mempool")
-
-        if not adopted and local_len == 0:
+        if not local_chain:
             genesis = self.blockchain.create_genesis()
             self.chain_storage.save_block(genesis.to_dict())
+            local_chain = [genesis]
             logger.info(f"Genesis created: h=0 hash={genesis.hash[:16]}...")
 
+        self.chain_state.reset(
+            local_chain,
+            self.chain_storage.get_all_balances(),
+            self.chain_storage.get_active_deltas(len(local_chain) - UNDO_DEPTH),
+        )
+        self._set_chain_cache(local_chain)
+        local_len = len(local_chain)
+        self._restore_mempool()
 
-        main_chain = self.chain_storage.load_chain()
-        self.known_hashes = {b.hash for b in main_chain}
+        seeds: Set[Tuple[str, int]] = set()
+        for seed in self.seed_peers or []:
+            seeds.add((seed.get('host'), int(seed.get('port'))))
 
-    def _try_adopt_longer_chain(self, min_target_len: int) -> tuple[bool, int]:
-        local_len = len(self.chain_storage.load_chain())
-        peers_set: set[tuple[str, int]] = set()
+        best_peer = self._sync_with_peers(seeds) if seeds else None
+        if best_peer:
+            logger.info(f"Adopted longer chain from seed: {len(self.chain)} blocks (local had {local_len})")
+
+        for peer_host, peer_port in ([best_peer] if best_peer else sorted(seeds)):
+            if not self.is_self_peer(peer_host, peer_port) and self.sync_mempool_with_peer(peer_host, peer_port):
+                break
+
+        self.known_hashes = set(self.height_by_hash)
+
+    def _restore_mempool(self) -> None:
+        """Reload the journaled mempool, revalidating it against the current tip in one batch."""
+        stored = self.mempool_storage.load()
+        if not stored:
+            return
+        recent_txids = {tx.transaction.txid for blk in self.chain[-UNDO_DEPTH:] for tx in blk.txs}
+        _, accepted = self.add_transactions([tx for tx in stored if tx.get("txid") not in recent_txids])
+        # re-admitted rows keep their place in the journal; only the rejected ones are deleted
+        accepted_txids = {tx["txid"] for tx in accepted}
+        for tx in stored:
+            if tx.get("txid") not in accepted_txids:
+                self.mempool_storage.record_remove(str(tx.get("txid")))
+        self.mempool_storage.flush()
+        logger.info(f"Restored {len(accepted)}/{len(stored)} journaled mempool transactions")
+
+    def _mempool_flush_worker(self) -> None:
+        while True:
+            time.sleep(MEMPOOL_FLUSH_INTERVAL)
+            try:
+                self.mempool_storage.flush()
+            except Exception as e:
+                logger.error(f"Mempool journal flush failed: {type(e).__name__}: {e}")
+
+    def sync_mempool_with_peer(self, peer_host: str, peer_port: int) -> bool:
+        """Reconcile mempools with a peer by comparing bucket digests; only txids in differing buckets are
+        listed, and only transactions one side lacks are transferred. Returns False if the peer did not answer."""
+        remote = self.network.fetch_mempool_digest(peer_host, peer_port)
+        if remote is None:
+            with self.mempool_sync_lock:
+                self.mempool_sync_stats["failed"] += 1
+            return False
+        local = self.mempool.digest()
+        differing = sorted(p for p in set(local) | set(remote) if local.get(p) != remote.get(p))
+
+        received = pushed = 0
+        if differing:
+            remote_txids = self.network.fetch_digest_buckets(peer_host, peer_port, differing)
+            if remote_txids is None:
+                with self.mempool_sync_lock:
+                    self.mempool_sync_stats["failed"] += 1
+                return False
+            theirs = {txid for txids in remote_txids.values() for txid in txids}
+            ours = {txid for txids in self.mempool.txids_in_buckets(differing).values() for txid in txids}
+
+            missing = sorted(theirs - ours)
+            fetched: List[Dict] = []
+            for i in range(0, len(missing), TX_BATCH_LIMIT):
+                fetched.extend(self.network.fetch_transactions_by_id(peer_host, peer_port, missing[i:i + TX_BATCH_LIMIT]) or [])
+            self.relay.mark_seen(peer_host, peer_port, "tx", theirs)
+            received = len(self._admit_unordered(fetched))
+
+            peer = [{"host": peer_host, "port": peer_port}]
+            for txid in sorted(ours - theirs):
+                signed_tx = self.mempool.get(txid)
+                if signed_tx is not None:
+                    self.relay.broadcast_transaction(peer, signed_tx.to_dict())
+                    pushed += 1
+
+        with self.mempool_sync_lock:
+            self.mempool_sync_stats["rounds"] += 1
+            self.mempool_sync_stats["buckets_differing"] += len(differing)
+            self.mempool_sync_stats["txs_received"] += received
+            self.mempool_sync_stats["txs_pushed"] += pushed
+        if received or pushed:
+            logger.info(f"Mempool sync with {peer_host}:{peer_port}: {len(differing)} differing buckets, "
+                        f"received {received}, pushed {pushed}")
+            if received:
+                self._notify_centralized_manager()
+        return True
+
+    def _admit_unordered(self, items: List[Dict]) -> List[Dict]:
+        """``add_transactions`` for dicts in no particular order: transactions spending an unconfirmed receipt
+        that arrived later in ``items`` are retried while each pass admits something."""
+        admitted: List[Dict] = []
+        pending = items
+        while pending:
+            results, accepted = self.add_transactions(pending)
+            admitted.extend(accepted)
+            retry = [pending[r["index"]] for r in results if r.get("error", "").startswith("Insufficient balance")]
+            if not accepted or len(retry) == len(pending):
+                break
+            pending = retry
+        return admitted
+
+    def _mempool_sync_worker(self) -> None:
+        while True:
+            time.sleep(MEMPOOL_SYNC_INTERVAL)
+            peers = self.storage.get_all_peers()
+            if not peers:
+                continue
+            peer = random.choice(peers)
+            try:
+                self.sync_mempool_with_peer(peer['host'], int(peer['port']))
+            except Exception as e:
+                logger.error(f"Mempool sync with {peer['host']}:{peer['port']} failed: {type(e).__name__}: {e}")
+
+    def _known_peers(self) -> Set[Tuple[str, int]]:
+        peers_set: Set[Tuple[str, int]] = set()
         for s in self.seed_peers or []:
             try:
                 peers_set.add((s.get('host'), int(s.get('port'))))
@@ -242,79 +392,315 @@ class NodeServer:
                     peers_set.add((host, int(port_val)))
             except Exception:
                 pass
+        return peers_set
 
-        best_chain = None
-        for host, port in peers_set:
-            chain_dicts = self.network.fetch_chain_from_peer(host, port)
-            if not chain_dicts:
-                continue
-            chain = [Block.from_dict(b) for b in chain_dicts]
-            if best_chain is None or len(chain) > len(best_chain):
-                best_chain = chain
-
-        if not best_chain:
+    def _try_adopt_longer_chain(self, min_target_len: int) -> tuple[bool, int]:
+        local_len = len(self.chain)
+        best_peer = self._sync_with_peers(self._known_peers(), min_target_len=min_target_len)
+        if best_peer is None:
             return (False, local_len)
 
-        target_len = len(best_chain)
-        if min_target_len is not None and target_len < min_target_len:
-            return (False, local_len)
-        if target_len <= local_len:
-            return (False, local_len)
+        logger.info(f"Runtime adoption: replaced local chain ({local_len}) with longer chain ({len(self.chain)})")
+        return (True, len(self.chain))
 
-        if not self.blockchain.validate_chain(best_chain):
-            return (False, local_len)
+    def _sync_with_peers(self, peers: Set[Tuple[str, int]], min_target_len: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """Headers-first sync: pick the best chain by validated headers, then download only its missing bodies."""
+        candidates = []
+        for host, port in peers:
+            if self.is_self_peer(host, port):
+                continue
+            tip = self.network.fetch_tip(host, port)
+            if not tip or int(tip["work"]) <= self.chain_state.work:
+                continue
+            height = int(tip["height"])
+            if min_target_len is not None and height + 1 < min_target_len:
+                continue
+            fetched = self._fetch_headers(host, port, height)
+            if fetched is None:
+                continue
+            ancestor_height, headers = fetched
+            work = self._work_at(ancestor_height) + sum(header_work(h["difficulty"]) for h in headers)
+            if work > self.chain_state.work:
+                candidates.append((work, ancestor_height, headers, host, port))
+
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        for work, ancestor_height, headers, host, port in candidates:
+            tip_hash = headers[-1]["hash"]
+            sources = [(host, port)] + [
+                (h, p) for _, _, other, h, p in candidates
+                if other[-1]["hash"] == tip_hash and (h, p) != (host, port)
+            ]
+            blocks = self._download_bodies(sources, headers)
+            if blocks is None:
+                continue
+            if self._adopt_blocks(ancestor_height, blocks):
+                return (host, port)
+        return None
 
-        self.chain_storage.replace_chain(best_chain)
+    def _work_at(self, height: int) -> int:
+        return self.chain_state.work - sum(block_work(b) for b in self.chain[height + 1:])
 
-        for block in best_chain:
-            self.remove_transactions_from_mempool(block)
+    def _fetch_headers(self, host: str, port: int, peer_height: int) -> Optional[Tuple[int, List[Dict]]]:
+        located = self.network.locate_on_peer(host, port, block_locator(self.chain), HEADERS_PAGE_LIMIT)
+        if not located:
+            return None
+        try:
+            ancestor_height = int(located["ancestor"]["height"])
+            ancestor_hash = str(located["ancestor"]["hash"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if self.height_by_hash.get(ancestor_hash) != ancestor_height:
+            logger.warning(f"Peer {host}:{port} reported an unknown fork point h={ancestor_height}")
+            return None
+
+        headers: List[Dict] = []
+        prev_hash = ancestor_hash
+        prev_height = ancestor_height
+        page = located.get("headers") or []
+        while page:
+            for header in page:
+                if not self.blockchain.validate_header(header, prev_hash, prev_height):
+                    logger.warning(f"Rejected headers from peer {host}:{port} at h={prev_height + 1}")
+                    return None
+                prev_hash = header["hash"]
+                prev_height = int(header["height"])
+            headers.extend(page)
+            if prev_height >= peer_height:
+                break
+            page = self.network.fetch_headers_from_peer(host, port, prev_height + 1, HEADERS_PAGE_LIMIT)
+        return (ancestor_height, headers) if headers else None
+
+    def _download_bodies(self, sources: List[Tuple[str, int]], headers: List[Dict]) -> Optional[List[Block]]:
+        blocks: List[Block] = []
+        for host, port in sources:
+            while len(blocks) < len(headers):
+                next_header = headers[len(blocks)]
+                page = self.network.fetch_blocks_from_peer(host, port, int(next_header["height"]), SYNC_PAGE_SIZE)
+                if not page:
+                    break
+                try:
+                    parsed = deserialize_chain(page)
+                except Exception as e:
+                    logger.warning(f"Rejected blocks from peer {host}:{port}: {e}")
+                    break
+                matched = 0
+                for block in parsed:
+                    if len(blocks) >= len(headers) or block.hash != headers[len(blocks)]["hash"]:
+                        break
+                    blocks.append(block)
+                    matched += 1
+                if matched == 0:
+                    break
+            if len(blocks) == len(headers):
+                return blocks
+        return None
+
+    def _adopt_blocks(self, ancestor_height: int, blocks: List[Block], rejected: Optional[List[Block]] = None) -> bool:
+        with self.chain_lock:
+            disconnected = self.chain[ancestor_height + 1:]
+            if self.chain_state.can_disconnect(self.chain_state.height - ancestor_height):
+                if not self._reorganize(ancestor_height, blocks, rejected):
+                    return False
+            else:
+                new_chain = self.chain[:ancestor_height + 1] + blocks
+                new_state = ChainState.from_chain(self.blockchain, new_chain)
+                if new_state is None:
+                    return False
+                self._replace_chain(new_chain, new_state)
 
-        logger.info(f"Runtime adoption: replaced local chain ({local_len}) with longer chain ({target_len})")
-        return (True, target_len)
+        self._revalidate_mempool(disconnected, blocks)
+        return True
 
-    def is_self_peer(self, peer_host: str, peer_port: int) -> bool:
-        return peer_host == self.host and peer_port == self.port
+    def _revalidate_mempool(self, disconnected: List[Block], connected: List[Block]) -> None:
+        """Return transactions of ``disconnected`` blocks to the mempool and recheck the whole pool against the new tip."""
+        restore = [signed_tx for block in disconnected for signed_tx in block.txs]
+        mined = [signed_tx.transaction.txid for block in connected for signed_tx in block.txs]
+        restored, dropped = self.mempool.revalidate(restore, mined)
+        self.block_template.reset()
+        logger.info(f"Mempool revalidated after chain switch: {len(disconnected)} blocks disconnected, "
+                    f"{restored} transactions restored, {dropped} dropped (mempool size: {len(self.mempool)})")
+        self._notify_centralized_manager()
+
+    def _reorganize(self, ancestor_height: int, blocks: List[Block], rejected: Optional[List[Block]] = None) -> bool:
+        """Disconnect the blocks above the fork point and connect ``blocks``, all or nothing; cost is proportional to fork depth.
+
+        On failure the block that did not connect is appended to ``rejected``.
+        """
+        with self.chain_lock:
+            disconnected: List[Block] = []
+            while self.chain_state.height > ancestor_height:
+                disconnected.append(self.chain_state.disconnect(self.chain[self.chain_state.height - 1]))
+
+            connected: List[Block] = []
+            for block in blocks:
+                if not self.chain_state.connect(block):
+                    break
+                connected.append(block)
 
-    def add_transaction(self, signed_tx: SignedTransaction) -> None:
-        for tx in self.pending_transactions:
-            if tx.signature == signed_tx.signature:
-                raise ValueError("Transaction already in mempool")
+            def rollback() -> None:
+                for i in reversed(range(len(connected))):
+                    self.chain_state.disconnect(connected[i - 1] if i > 0 else self.chain[ancestor_height])
+                for block in reversed(disconnected):
+                    self.chain_state.connect(block)
+
+            if len(connected) < len(blocks):
+                if rejected is not None:
+                    rejected.append(blocks[len(connected)])
+                rollback()
+                return False
+
+            try:
+                self.chain_storage.reorganize(ancestor_height, blocks)
+            except Exception:
+                rollback()
+                raise
+            for block in disconnected:
+                self.height_by_hash.pop(block.hash, None)
+            del self.chain[ancestor_height + 1:]
+            self.chain.extend(blocks)
+            for block in blocks:
+                self.height_by_hash[block.hash] = block.height
+
+        logger.info(f"Reorganized at h={ancestor_height}: disconnected {len(disconnected)}, connected {len(blocks)} blocks")
+        return True
 
-        transaction = signed_tx.transaction
+    def _set_chain_cache(self, chain: List[Block]) -> None:
+        self.chain = list(chain)
+        self.height_by_hash = {b.hash: b.height for b in self.chain}
 
-        if transaction.sender is None:
-            raise ValueError("Coinbase transaction rejected - coinbase can only be created during mining")
+    def _connect_block(self, block: Block) -> bool:
+        with self.chain_lock:
+            if not self.chain_state.connect(block):
+                return False
+            try:
+                self.chain_storage.save_block(block.to_dict())
+            except Exception:
+                self.chain_state.disconnect(self.chain[-1] if self.chain else None)
+                raise
+            self.chain.append(block)
+            self.height_by_hash[block.hash] = block.height
+            return True
 
-        chain = self.chain_storage.load_chain()
+    def _replace_chain(self, chain: List[Block], state: ChainState) -> None:
+        with self.chain_lock:
+            self.chain_storage.replace_chain(chain)
+            self.chain_state = state
+            self._set_chain_cache(chain)
+
+    def get_block_by_hash(self, block_hash: str) -> Optional[Block]:
+        height = self.height_by_hash.get(block_hash)
+        if height is None or height >= len(self.chain):
+            return None
+        return self.chain[height]
+
+    def _reconstruct_compact_block(self, compact: Dict) -> Tuple[Dict, List[str]]:
+        """Full block dict from a compact block and the mempool, plus txids that are in neither (or whose mempool
+        copies do not match the block's merkle root)."""
+        txids = [str(txid) for txid in compact["txids"]]
+        supplied = {tx["txid"]: tx for tx in compact.get("missing_txs") or []}
+        if compact.get("coinbase") is not None:
+            supplied[compact["coinbase"]["txid"]] = compact["coinbase"]
+
+        txs: List[Dict] = []
+        missing: List[str] = []
+        for txid in txids:
+            if txid in supplied:
+                txs.append(supplied[txid])
+            elif txid in self.mempool:
+                txs.append(self.mempool.get(txid).to_dict())
+            else:
+                missing.append(txid)
+        if not missing and merkle_root([merkle_leaf(tx["txid"], tx["signature"]) for tx in txs]) != compact.get("merkle_root"):
+            # a mempool copy carries a different (malleated) signature than the block; fetch the block's own copies
+            missing = [txid for txid in txids if txid not in supplied]
+
+        with self.compact_lock:
+            self.compact_stats["received"] += 1
+            if missing:
+                self.compact_stats["missing_requests"] += 1
+                self.compact_stats["missing_txs"] += len(missing)
+            elif not compact.get("missing_txs"):
+                self.compact_stats["reconstructed_from_mempool"] += 1
+
+        block = {k: v for k, v in compact.items() if k not in ("coinbase", "txids", "missing_txs")}
+        block["txs"] = txs
+        return block, missing
+
+    def has_block(self, block_hash: str) -> bool:
+        return (block_hash in self.height_by_hash or block_hash in self.known_hashes
+                or self.chain_storage.has_block(block_hash))
 
-        sender_public_key = transaction.sender
-        sender_balance = calculate_balance_with_mempool(chain, sender_public_key, self.pending_transactions)
-        if sender_balance < transaction.amount:
-            raise ValueError(f"Insufficient balance: {sender_balance} < {transaction.amount}")
+    def is_self_peer(self, peer_host: str, peer_port: int) -> bool:
+        return peer_host == self.host and peer_port == self.port
 
-        self.pending_transactions.append(signed_tx)
+    def add_transaction(self, signed_tx: SignedTransaction) -> None:
+        self.mempool.add(signed_tx)
+        self.block_template.added(signed_tx)
         logger.info(
-            f"Added transaction to mempool: {signed_tx.transaction.txid[:16]}... (mempool size: {len(self.pending_transactions)})")
+            f"Added transaction to mempool: {signed_tx.transaction.txid[:16]}... (mempool size: {len(self.mempool)})")
+
+    def add_transactions(self, items: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """Admit transaction dicts in order, verifying all signatures as one batch; returns per-item results and the accepted dicts."""
+        results: List[Dict] = [{"index": i, "status": "rejected"} for i in range(len(items))]
+        parsed: List[Tuple[int, SignedTransaction]] = []
+        for i, item in enumerate(items):
+            try:
+                parsed.append((i, SignedTransaction(Transaction.from_dict(item), str(item["signature"]))))
+            except Exception as e:
+                results[i]["error"] = f"invalid transaction: {e}"
+
+        valid = verify_signatures_batch([signed_tx for _, signed_tx in parsed])
+        accepted: List[Dict] = []
+        for (i, signed_tx), signature_ok in zip(parsed, valid):
+            results[i]["txid"] = signed_tx.transaction.txid
+            if not signature_ok:
+                results[i]["error"] = "invalid transaction: invalid signature"
+                continue
+            try:
+                self.add_transaction(signed_tx)
+            except Exception as e:
+                results[i]["error"] = str(e)
+                continue
+            results[i]["status"] = "accepted"
+            accepted.append(items[i])
+        return results, accepted
+
+    def balance_with_mempool(self, public_key: str) -> float:
+        return self.chain_state.balance_of(public_key) + self.mempool.balance_delta(public_key)
 
     def broadcast_transaction(self, transaction: dict):
         peers = self.storage.get_all_peers()
-        self.network.broadcast_transaction(peers, transaction)
+        self.relay.broadcast_transaction(peers, transaction)
 
     def remove_transactions_from_mempool(self, block: Block):
-        block_txids = {tx.transaction.txid for tx in block.txs}
+        """Drop the block's transactions from the mempool, then pending spends of its senders that the new
+        balances no longer cover (conflicting spends in the block) along with whatever relied on them."""
+        removed = self.mempool.remove(signed_tx.transaction.txid for signed_tx in block.txs)
+        dropped = self.mempool.recheck({signed_tx.transaction.sender for signed_tx in block.txs[1:]})
+        self.block_template.refresh()
+        if removed:
+            logger.info(f"Removed {len(removed)} transactions from mempool (found in new block)")
+        if dropped:
+            logger.info(f"Dropped {len(dropped)} mempool transactions made unaffordable by block {block.hash}")
+        if removed or dropped:
+            self._notify_centralized_manager()
 
-        original_count = len(self.pending_transactions)
-        self.pending_transactions = [
-            tx for tx in self.pending_transactions
-            if tx.transaction.txid not in block_txids
-        ]
-        removed_count = original_count - len(self.pending_transactions)
+        return len(removed)
 
-        if removed_count > 0:
-            logger.info(f"Removed {removed_count} transactions from mempool (found in new block)")
-            self._notify_centralized_manager()
+    def _inv_origin(self, origin) -> Optional[Tuple[str, int]]:
+        """The announcing peer of an /inv call, if its claimed address is a known peer on the caller's own IP.
 
-        return removed_count
+        Marking objects as seen suppresses relay to that peer, so it is not done for unverified origins.
+        """
+        if not isinstance(origin, dict) or not origin.get("host") or not origin.get("port"):
+            return None
+        try:
+            peer = (str(origin["host"]), int(origin["port"]))
+        except (TypeError, ValueError):
+            return None
+        if peer[0] != request.remote_addr or peer not in self._known_peers():
+            return None
+        return peer
 
     def _remove_inactive_peers(self):
         peer_list = self.storage.get_all_peers()
@@ -383,38 +769,132 @@ class NodeServer:
 
         @self.app.route('/blocks', methods=['GET'])
         def get_blocks():
-            chain = self.chain_storage.load_chain()
+            from_height = request.args.get('from', type=int)
+            limit = request.args.get('limit', type=int)
+            if from_height is None and limit is None:
+                chain = list(self.chain)
+                return jsonify([block.to_dict() for block in chain]), 200
+
+            from_height = max(0, from_height or 0)
+            limit = min(BLOCKS_PAGE_LIMIT, max(0, limit if limit is not None else BLOCKS_PAGE_LIMIT))
+            chain = self.chain[from_height:from_height + limit]
             return jsonify([block.to_dict() for block in chain]), 200
 
+        @self.app.route('/blocks/<block_hash>', methods=['GET'])
+        def get_block(block_hash):
+            block = self.get_block_by_hash(block_hash)
+            if block is not None:
+                return jsonify(block.to_dict()), 200
+            stored = self.chain_storage.get_block(block_hash)
+            if stored is not None:
+                return jsonify(stored), 200
+            return jsonify({"error": "block not found"}), 404
+
+        @self.app.route('/inv', methods=['POST'])
+        def receive_inventory():
+            data = request.get_json(silent=True) or {}
+            block_hashes = [str(h) for h in data.get("blocks") or []]
+            txids = [str(t) for t in data.get("txs") or []]
+
+            origin = self._inv_origin(data.get("from"))
+            if origin is not None:
+                self.relay.mark_seen(origin[0], origin[1], "block", block_hashes)
+                self.relay.mark_seen(origin[0], origin[1], "tx", txids)
+
+            return jsonify({"getdata": {
+                "blocks": [h for h in block_hashes if not self.has_block(h)],
+                "txs": [t for t in txids if t not in self.mempool],
+            }}), 200
+
+        @self.app.route('/headers', methods=['GET'])
+        def get_headers():
+            from_height = max(0, request.args.get('from', default=0, type=int))
+            limit = request.args.get('limit', default=HEADERS_PAGE_LIMIT, type=int)
+            limit = min(HEADERS_PAGE_LIMIT, max(0, limit))
+            chain = self.chain[from_height:from_height + limit]
+            return jsonify([block.header_dict() for block in chain]), 200
+
+        @self.app.route('/locate', methods=['POST'])
+        def locate():
+            data = request.get_json() or {}
+            locator = data.get('locator')
+            if not isinstance(locator, list):
+                return jsonify({"error": "missing locator"}), 400
+            headers_only = bool(data.get('headers_only', True))
+            max_limit = HEADERS_PAGE_LIMIT if headers_only else BLOCKS_PAGE_LIMIT
+            try:
+                limit = min(max_limit, max(0, int(data.get('limit', max_limit))))
+            except (TypeError, ValueError):
+                return jsonify({"error": "invalid limit"}), 400
+
+            ancestor_height = next(
+                (self.height_by_hash[h] for h in locator if isinstance(h, str) and h in self.height_by_hash),
+                None,
+            )
+            if ancestor_height is None:
+                return jsonify({"error": "no common ancestor"}), 404
+
+            chain = self.chain[ancestor_height + 1:ancestor_height + 1 + limit]
+            key = "headers" if headers_only else "blocks"
+            return jsonify({
+                "ancestor": {"height": ancestor_height, "hash": self.chain[ancestor_height].hash},
+                "tip_height": self.chain_state.height,
+                key: [block.header_dict() if headers_only else block.to_dict() for block in chain],
+            }), 200
+
+        @self.app.route('/tip', methods=['GET'])
+        def get_tip():
+            tip = self.chain_state.tip
+            return jsonify({
+                "height": self.chain_state.height,
+                "hash": tip.hash if tip else None,
+                "work": self.chain_state.work,
+            }), 200
+
         @self.app.route('/blocks', methods=['POST'])
         def receive_block():
             data = request.get_json()
             if not data:
                 return jsonify({"error": "missing block body"}), 400
+            if "txids" in data:
+                if data.get("hash") in self.height_by_hash or self.chain_storage.has_block(str(data.get("hash"))):
+                    return jsonify({"status": "duplicate", "height": data.get("height")}), 200
+                try:
+                    data, missing = self._reconstruct_compact_block(data)
+                except Exception as e:
+                    return jsonify({"error": f"malformed compact block: {e}"}), 400
+                if missing:
+                    return jsonify({"status": "missing", "missing": missing}), 200
             try:
                 incoming = Block.from_dict(data)
             except Exception as e:
                 return jsonify({"error": f"malformed block: {e}"}), 400
 
-            last = self.chain_storage.get_last_block()
-            prev = Block.from_dict(last) if last else None
-
-            chain = self.chain_storage.load_chain()
+            prev = self.chain_state.tip
 
-            if any(b.hash == incoming.hash for b in chain):
+            if incoming.hash in self.height_by_hash or self.chain_storage.has_block(incoming.hash):
                 return jsonify({"status": "duplicate", "height": incoming.height}), 200
-            chain_with_incoming = chain + [incoming]
 
-            if not self.blockchain.validate_chain(chain_with_incoming):
+            if not self._connect_block(incoming):
+                if incoming.height == 0 or (prev is not None and incoming.prev_hash == prev.hash):
+                    return jsonify({"error": "invalid block"}), 400
 
                 local_height = prev.height if prev else -1
 
 
-                if incoming.prev_hash in self.known_hashes:
+                parent_dict = self.chain_storage.get_block(incoming.prev_hash)
+                if parent_dict is not None:
 
-                    parent_block = next((b for b in chain if b.hash == incoming.prev_hash), None)
-                    if parent_block and self.blockchain.validate_block(incoming, parent_block):
-                        self._store_orphan(incoming)
+                    parent_block = Block.from_dict(parent_dict, trusted=True)
+                    if self.blockchain.validate_block(incoming, parent_block):
+                        self._store_side_block(incoming)
+
+                        if self._activate_best_branch():
+                            self._interrupt_mining()
+                            self._notify_centralized_manager()
+                            return jsonify({"status": "reorganized", "height": self.chain_state.height}), 201
+                        if not self.chain_storage.has_block(incoming.hash):
+                            return jsonify({"error": "invalid block"}), 400
 
                         if incoming.height > local_height:
                             adopted, new_len = self._try_adopt_longer_chain(min_target_len=incoming.height + 1)
@@ -424,8 +904,7 @@ class NodeServer:
                                 self._notify_centralized_manager()
                                 return jsonify({"status": "reorganized", "height": new_len - 1}), 201
 
-                        self._prune_orphans()
-                        return jsonify({"status": "orphan-buffered", "height": incoming.height}), 202
+                        return jsonify({"status": "side-branch", "height": incoming.height}), 202
                 else:
 
                     self._store_orphan(incoming)
@@ -443,8 +922,6 @@ class NodeServer:
                         return jsonify({"status": "reorganized", "height": new_len - 1}), 201
                 return jsonify({"error": "invalid block"}), 400
 
-            self.chain_storage.save_block(incoming.to_dict())
-
             self.remove_transactions_from_mempool(incoming)
 
 
@@ -453,7 +930,7 @@ class NodeServer:
             self._prune_orphans()
 
             peers = self.storage.get_all_peers()
-            self.network.broadcast_block(peers, incoming.to_dict())
+            self.relay.broadcast_block(peers, incoming.to_dict())
 
             self._notify_centralized_manager()
 
@@ -467,22 +944,22 @@ class NodeServer:
             if self.role != "miner":
                 return jsonify({"error": "node is not a miner"}), 403
 
-            last_d = self.chain_storage.get_last_block()
-            prev = Block.from_dict(last_d) if last_d else self.blockchain.create_genesis()
+            prev = self.chain_state.tip or self.blockchain.create_genesis()
 
-            new_block = self.blockchain.mine_next_block(prev, self.public_key, txs=self.pending_transactions)
+            new_block = self.blockchain.mine_next_block(prev, self.public_key, self.block_template)
             if new_block is None:
                 return jsonify({"error": "mining interrupted"}), 503
-            self.chain_storage.save_block(new_block.to_dict())
+            if not self._connect_block(new_block):
+                return jsonify({"error": "chain tip changed while mining"}), 409
 
-            self.pending_transactions.clear()
+            self.remove_transactions_from_mempool(new_block)
 
 
             self.known_hashes.add(new_block.hash)
             self._flush_orphans_extending_tip()
 
             peers = self.storage.get_all_peers()
-            self.network.broadcast_block(peers, new_block.to_dict())
+            self.relay.broadcast_block(peers, new_block.to_dict())
 
             self._notify_centralized_manager()
 
@@ -490,33 +967,35 @@ class NodeServer:
 
         @self.app.route('/balance/<public_key>', methods=['GET'])
         def get_balance(public_key):
-            chain = self.chain_storage.load_chain()
-            balance = calculate_balance_with_mempool(chain, public_key, self.pending_transactions)
+            balance = self.balance_with_mempool(public_key)
             return str(balance), 200
 
         @self.app.route('/info', methods=['GET'])
         def get_info():
-            chain = self.chain_storage.load_chain()
-            balance = calculate_balance_with_mempool(chain, self.public_key, self.pending_transactions)
+            chain = list(self.chain)
+            balance = self.balance_with_mempool(self.public_key)
 
             orphan_blocks: List[Dict] = []
             for lst in self.orphans_by_prev.values():
                 for b in lst:
                     orphan_blocks.append(b.to_dict())
 
+            min_height = max(0, self.chain_state.height - ORPHAN_MAX_DEPTH)
+            orphan_blocks.extend(self.chain_storage.load_side_blocks(min_height))
+
             orphan_blocks.sort(key=lambda d: (int(d.get("height", -1)), str(d.get("hash", ""))))
             return jsonify({
                 "public_key": self.public_key,
                 "balance": balance,
                 "role": self.role,
                 "chain": [block.to_dict() for block in chain],
-                "pending_transactions": [tx.to_dict() for tx in self.pending_transactions],
+                "pending_transactions": [tx.to_dict() for tx in self.mempool.transactions()],
                 "forks": orphan_blocks
             }), 200
 
         @self.app.route('/transactions', methods=['GET'])
         def get_transactions():
-            return jsonify([tx.to_dict() for tx in self.pending_transactions]), 200
+            return jsonify([tx.to_dict() for tx in self.mempool.transactions()]), 200
 
         @self.app.route('/transactions', methods=['POST'])
         def receive_transaction():
@@ -530,18 +1009,64 @@ class NodeServer:
                 return jsonify({"error": f"invalid transaction: {e}"}), 400
 
             try:
-                prev_count = len(self.pending_transactions)
                 self.add_transaction(signed_tx)
-                new_count = len(self.pending_transactions)
-
-                if prev_count < MINING_MIN and new_count > MINING_MIN:
-                    self._interrupt_mining()
                 self.broadcast_transaction(data)
                 self._notify_centralized_manager()
                 return jsonify({"status": "accepted", "txid": signed_tx.transaction.txid}), 201
             except Exception as e:
                 return jsonify({"status": "rejected", "txid": signed_tx.transaction.txid, "error": str(e)}), 400
 
+        @self.app.route('/transactions/digest', methods=['GET'])
+        def get_mempool_digest():
+            return jsonify({"count": len(self.mempool), "buckets": self.mempool.digest()}), 200
+
+        @self.app.route('/transactions/digest', methods=['POST'])
+        def get_digest_buckets():
+            data = request.get_json(silent=True) or {}
+            prefixes = data.get("buckets")
+            if not isinstance(prefixes, list):
+                return jsonify({"error": "expected a list of bucket prefixes"}), 400
+            return jsonify({"txids": self.mempool.txids_in_buckets(str(p) for p in prefixes)}), 200
+
+        @self.app.route('/transactions/fetch', methods=['POST'])
+        def fetch_transactions():
+            data = request.get_json(silent=True) or {}
+            txids = data.get("txids")
+            if not isinstance(txids, list):
+                return jsonify({"error": "expected a list of txids"}), 400
+            if len(txids) > TX_BATCH_LIMIT:
+                return jsonify({"error": f"at most {TX_BATCH_LIMIT} txids per request"}), 400
+            found = (self.mempool.get(str(txid)) for txid in txids)
+            return jsonify([signed_tx.to_dict() for signed_tx in found if signed_tx is not None]), 200
+
+        @self.app.route('/transactions/batch', methods=['POST'])
+        def receive_transactions_batch():
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                data = data.get("transactions")
+            if not isinstance(data, list) or not data:
+                return jsonify({"error": "expected a non-empty list of transactions"}), 400
+            if len(data) > TX_BATCH_LIMIT:
+                return jsonify({"error": f"at most {TX_BATCH_LIMIT} transactions per batch"}), 400
+
+            results, accepted = self.add_transactions(data)
+
+            if accepted:
+                peers = self.storage.get_all_peers()
+                for tx_dict in accepted:
+                    self.relay.broadcast_transaction(peers, tx_dict)
+                self._notify_centralized_manager()
+
+            return jsonify({
+                "accepted": len(accepted),
+                "rejected": len(data) - len(accepted),
+                "results": results,
+            }), 200
+
+        @self.app.route('/metrics', methods=['GET'])
+        def get_metrics():
+            return jsonify(self.metrics()), 200
+
         @self.app.route('/miner/start', methods=['POST'])
         def miner_start():
             if self.role != "miner":
@@ -557,7 +1082,26 @@ class NodeServer:
         @self.app.route('/miner/status', methods=['GET'])
         def miner_status():
             is_running = self.mining_enabled and self.mining_thread and self.mining_thread.is_alive()
-            return jsonify({"running": bool(is_running), "role": self.role}), 200
+            stats = self.mining_pool.stats() if self.mining_pool else {"workers": [], "hashes": 0, "hashrate": 0.0}
+            return jsonify({
+                "running": bool(is_running),
+                "role": self.role,
+                "workers": stats["workers"],
+                "hashes": stats["hashes"],
+                "hashrate": stats["hashrate"],
+            }), 200
+
+    def metrics(self) -> Dict:
+        return {
+            "signature_cache": signature_cache.stats(),
+            "broadcast": self.network.broadcast_stats(),
+            "relay": self.relay.stats(),
+            "connections": self.network.connection_stats(),
+            "compact_blocks": dict(self.compact_stats),
+            "mempool": self.mempool.stats(),
+            "block_template": self.block_template.stats(),
+            "mempool_sync": dict(self.mempool_sync_stats),
+        }
 
     def bootstrap(self):
         logger.info(f"Bootstrapping node with {len(self.seed_peers)} seed peers")
@@ -596,12 +1140,17 @@ class NodeServer:
     def run(self):
         if self.seed_peers:
             Thread(target=self.bootstrap, daemon=True).start()
+        Thread(target=self._mempool_sync_worker, daemon=True).start()
 
         logger.info(f"Starting node on {self.host}:{self.port} role={self.role}")
 
         if self.role == "miner":
             self.start_mining()
-        self.app.run(host=self.host, port=self.port)
+        try:
+            self.app.run(host=self.host, port=self.port)
+        finally:
+            self.stop_mining()
+            self.mempool_storage.flush()
 
 
     def _store_orphan(self, block: Block) -> None:
@@ -613,10 +1162,9 @@ class NodeServer:
 
     def _flush_orphans_extending_tip(self) -> None:
         while True:
-            last_d = self.chain_storage.get_last_block()
-            if not last_d:
+            if self.chain_state.tip is None:
                 break
-            tip_hash = str(last_d["hash"])
+            tip_hash = self.chain_state.tip.hash
             candidates = self.orphans_by_prev.get(tip_hash) or []
             if not candidates:
                 break
@@ -630,14 +1178,11 @@ class NodeServer:
 
                 self.orphans_by_prev[tip_hash] = candidates
 
-            chain = self.chain_storage.load_chain()
-            chain_with = chain + [next_block]
-            if self.blockchain.validate_chain(chain_with):
-                self.chain_storage.save_block(next_block.to_dict())
+            if self._connect_block(next_block):
                 self.remove_transactions_from_mempool(next_block)
                 self.known_hashes.add(next_block.hash)
                 peers = self.storage.get_all_peers()
-                self.network.broadcast_block(peers, next_block.to_dict())
+                self.relay.broadcast_block(peers, next_block.to_dict())
                 self._notify_centralized_manager()
                 logger.info(f"Attached orphan h={next_block.height} to tip; chain extended")
 
@@ -647,13 +1192,52 @@ class NodeServer:
                 self.orphans_by_prev.setdefault(tip_hash, []).append(next_block)
                 break
 
+    def _store_side_block(self, block: Block) -> None:
+        """Keep a valid block that does not extend the tip in the block tree, with any buffered descendants."""
+        pending = [block]
+        while pending:
+            side_block = pending.pop()
+            if self.chain_storage.add_side_block(side_block.to_dict()):
+                self._side_blocks_pruned_below = min(self._side_blocks_pruned_below, side_block.height)
+                logger.info(f"Stored side-branch block h={side_block.height} hash={side_block.hash[:16]}...")
+            self.known_hashes.add(side_block.hash)
+            for child in self.orphans_by_prev.pop(side_block.hash, []):
+                if self.blockchain.validate_block(child, side_block):
+                    pending.append(child)
+
+    def _activate_best_branch(self) -> bool:
+        """Switch the active chain to the most-work tip in the block tree if it beats the current tip.
+
+        When a branch fails validation, the block that failed is dropped from the tree with all its descendants
+        (the whole branch above the fork if it cannot be told which one), and the next best tip is tried.
+        """
+        with self.chain_lock:
+            while True:
+                best = self.chain_storage.get_best_tip()
+                if best is None or best["work"] <= self.chain_state.work:
+                    return False
+                invalid = best["hash"]
+                branch = self.chain_storage.get_branch(best["hash"])
+                if branch is not None:
+                    fork_height, block_dicts = branch
+                    blocks = [Block.from_dict(d, trusted=True) for d in block_dicts]
+                    rejected: List[Block] = []
+                    if self._adopt_blocks(fork_height, blocks, rejected):
+                        logger.info(f"Activated stored branch: fork at h={fork_height}, new tip h={best['height']}")
+                        return True
+                    invalid = rejected[0].hash if rejected else blocks[0].hash
+                dropped = self.chain_storage.discard_branch(invalid)
+                logger.warning(f"Dropped {dropped} stored blocks from {invalid[:16]}... up to tip h={best['height']}: "
+                               f"branch is invalid")
+
     def _prune_orphans(self) -> None:
-        """Prune orphan blocks that are too old relative to the tip (local-only)."""
-        try:
-            last_d = self.chain_storage.get_last_block()
-            tip_h = int(last_d["height"]) if last_d else -1
-        except Exception:
-            tip_h = -1
+        """Prune orphan blocks that are too old relative to the tip (local-only), and stored side blocks that
+        are too deep to reorganize to."""
+        tip_h = self.chain_state.height
+        prune_below = tip_h - UNDO_DEPTH
+        if prune_below - self._side_blocks_pruned_below >= SIDE_BLOCK_PRUNE_INTERVAL:
+            self.chain_storage.prune_side_blocks(self._side_blocks_pruned_below, prune_below)
+            self._side_blocks_pruned_below = prune_below
 
 
         for parent_hash, lst in list(self.orphans_by_prev.items()):
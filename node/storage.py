@@ -1,9 +1,12 @@
 import json
 import sqlite3
-from typing import Dict, List, Tuple
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 
-from node.blockchain import Block
-from node.transactions import serialize_signed_transactions
+from node.blockchain import Block, header_work
+
+BLOCK_COLUMNS = 'height, prev_hash, timestamp, txs_json, nonce, difficulty, miner, hash, version, merkle_root'
+TREE_COLUMNS = ', '.join(f'b.{column}' for column in BLOCK_COLUMNS.split(', '))
 
 
 class PeerStorage:
@@ -57,6 +60,12 @@ class PeerStorage:
 
 
 class ChainStorage:
+    """Block tree keyed by hash (parent pointer, height, cumulative work) plus the active chain as height -> hash.
+
+    Balances in account_balances always describe the active chain; block_deltas holds the net balance change
+    of every stored block, so switching branches only applies and undoes the deltas of the blocks that move.
+    """
+
     def __init__(self, db_path: str):
         self.db_path = db_path
         self._init_db()
@@ -65,106 +74,390 @@ class ChainStorage:
         with sqlite3.connect(self.db_path) as conn:
             conn.execute(
                 '''
-                CREATE TABLE IF NOT EXISTS blocks (
-                    height INTEGER PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS block_tree (
+                    hash TEXT PRIMARY KEY,
                     prev_hash TEXT NOT NULL,
+                    height INTEGER NOT NULL,
+                    work INTEGER NOT NULL,
                     timestamp INTEGER NOT NULL,
                     txs_json TEXT NOT NULL,
                     nonce INTEGER NOT NULL,
                     difficulty INTEGER NOT NULL,
                     miner TEXT NOT NULL,
-                    hash TEXT NOT NULL
+                    version INTEGER NOT NULL DEFAULT 1,
+                    merkle_root TEXT
                 )
                 '''
             )
-            conn.commit()
-
-    def save_block(self, block: Dict):
-        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_block_tree_prev ON block_tree (prev_hash)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_block_tree_height ON block_tree (height)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_block_tree_work ON block_tree (work)')
             conn.execute(
                 '''
-                INSERT OR IGNORE INTO blocks (height, prev_hash, timestamp, txs_json, nonce, difficulty, miner, hash)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''',
-                (
-                    int(block["height"]),
-                    str(block["prev_hash"]),
-                    int(block["timestamp"]),
-                    json.dumps(block.get("txs") or []),
-                    int(block["nonce"]),
-                    int(block["difficulty"]),
-                    str(block.get("miner", "")),
-                    str(block["hash"]),
-                ),
+                CREATE TABLE IF NOT EXISTS active_chain (
+                    height INTEGER PRIMARY KEY,
+                    hash TEXT NOT NULL UNIQUE
+                )
+                '''
+            )
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS account_balances (
+                    public_key TEXT PRIMARY KEY,
+                    balance REAL NOT NULL
+                )
+                '''
+            )
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS block_deltas (
+                    hash TEXT NOT NULL,
+                    public_key TEXT NOT NULL,
+                    delta REAL NOT NULL,
+                    PRIMARY KEY (hash, public_key)
+                )
+                '''
             )
             conn.commit()
 
-    def replace_chain(self, chain: List[Block]):
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if 'blocks' in tables:
+                self._migrate_linear_chain(conn)
 
+    def _migrate_linear_chain(self, conn: sqlite3.Connection) -> None:
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(blocks)')}
+        version = 'version' if 'version' in columns else '1'
+        merkle_root = 'merkle_root' if 'merkle_root' in columns else 'NULL'
+        rows = conn.execute(
+            f'SELECT height, prev_hash, timestamp, txs_json, nonce, difficulty, miner, hash, {version}, {merkle_root} '
+            'FROM blocks ORDER BY height ASC'
+        ).fetchall()
+
+        cur = conn.cursor()
+        try:
+            cur.execute('BEGIN')
+            cur.execute('DELETE FROM account_balances')
+            for row in rows:
+                block = self._row_to_dict(row)
+                self._insert_block(cur, block)
+                self._activate(cur, block["hash"], block["height"])
+            cur.execute('DROP TABLE blocks')
+            cur.execute('DROP TABLE IF EXISTS balance_deltas')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    @staticmethod
+    def _block_row(block: Dict, work: int) -> Tuple:
+        return (
+            int(block["height"]),
+            str(block["prev_hash"]),
+            int(block["timestamp"]),
+            json.dumps(block.get("txs") or []),
+            int(block["nonce"]),
+            int(block["difficulty"]),
+            str(block.get("miner", "")),
+            str(block["hash"]),
+            int(block.get("version", 1)),
+            block.get("merkle_root"),
+            work,
+        )
+
+    @staticmethod
+    def _row_to_dict(row: Tuple) -> Dict:
+        block = {
+            "height": int(row[0]),
+            "prev_hash": row[1],
+            "timestamp": int(row[2]),
+            "txs": json.loads(row[3]),
+            "nonce": int(row[4]),
+            "difficulty": int(row[5]),
+            "miner": row[6],
+            "hash": row[7],
+        }
+        if int(row[8]) > 1:
+            block["version"] = int(row[8])
+            block["merkle_root"] = row[9]
+        return block
+
+    @staticmethod
+    def _balance_deltas(txs: List[Dict]) -> Dict[str, float]:
+        deltas: Dict[str, float] = {}
+        for tx in txs:
+            amount = float(tx["amount"])
+            if tx.get("sender") is not None:
+                deltas[tx["sender"]] = deltas.get(tx["sender"], 0.0) - amount
+            deltas[tx["recipient"]] = deltas.get(tx["recipient"], 0.0) + amount
+        return deltas
+
+    def _insert_block(self, cur: sqlite3.Cursor, block: Dict) -> bool:
+        block_hash = str(block["hash"])
+        if cur.execute('SELECT 1 FROM block_tree WHERE hash = ?', (block_hash,)).fetchone():
+            return False
+        parent = cur.execute('SELECT work FROM block_tree WHERE hash = ?', (str(block["prev_hash"]),)).fetchone()
+        work = (int(parent[0]) if parent else 0) + header_work(int(block["difficulty"]))
+        cur.execute(
+            f'INSERT INTO block_tree ({BLOCK_COLUMNS}, work) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            self._block_row(block, work),
+        )
+        for public_key, delta in self._balance_deltas(block.get("txs") or []).items():
+            cur.execute(
+                'INSERT INTO block_deltas (hash, public_key, delta) VALUES (?, ?, ?)',
+                (block_hash, public_key, delta),
+            )
+        return True
+
+    def _activate(self, cur: sqlite3.Cursor, block_hash: str, height: int) -> None:
+        cur.execute('INSERT INTO active_chain (height, hash) VALUES (?, ?)', (height, block_hash))
+        cur.execute(
+            '''
+            INSERT INTO account_balances (public_key, balance)
+            SELECT public_key, delta FROM block_deltas WHERE hash = ?
+            ON CONFLICT(public_key) DO UPDATE SET balance = balance + excluded.balance
+            ''',
+            (block_hash,),
+        )
+
+    def _deactivate_above(self, cur: sqlite3.Cursor, height: int) -> None:
+        rows = cur.execute(
+            '''
+            SELECT d.public_key, SUM(d.delta) FROM active_chain a JOIN block_deltas d ON d.hash = a.hash
+            WHERE a.height > ? GROUP BY d.public_key
+            ''',
+            (height,),
+        ).fetchall()
+        for public_key, delta in rows:
+            cur.execute(
+                'UPDATE account_balances SET balance = balance - ? WHERE public_key = ?',
+                (delta, public_key),
+            )
+        cur.execute('DELETE FROM active_chain WHERE height > ?', (height,))
+
+    def _fork_height(self, cur: sqlite3.Cursor, chain: List[Block]) -> int:
+        top = cur.execute('SELECT MAX(height) FROM active_chain').fetchone()[0]
+        if top is None:
+            return -1
+        for block in reversed(chain[:top + 1]):
+            row = cur.execute('SELECT hash FROM active_chain WHERE height = ?', (block.height,)).fetchone()
+            if row and row[0] == block.hash:
+                return block.height
+        return -1
+
+    def _write(self, fn) -> None:
         with sqlite3.connect(self.db_path) as conn:
             cur = conn.cursor()
             try:
                 cur.execute('BEGIN')
-                cur.execute('DELETE FROM blocks')
-                for block in chain:
-                    cur.execute(
-                        '''
-                        INSERT INTO blocks (height, prev_hash, timestamp, txs_json, nonce, difficulty, miner, hash)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        ''',
-                        (
-                            block.height,
-                            block.prev_hash,
-                            block.timestamp,
-                            json.dumps(serialize_signed_transactions(block.txs)),
-                            block.nonce,
-                            block.difficulty,
-                            block.miner,
-                            block.hash,
-                        ),
-                    )
+                fn(cur)
                 conn.commit()
             except Exception:
                 conn.rollback()
                 raise
 
+    def save_block(self, block: Dict):
+        """Store ``block`` and append it to the active chain; raises ValueError if another block is active at its height."""
+        def write(cur: sqlite3.Cursor) -> None:
+            self._insert_block(cur, block)
+            height = int(block["height"])
+            row = cur.execute('SELECT hash FROM active_chain WHERE height = ?', (height,)).fetchone()
+            if row is None:
+                self._activate(cur, str(block["hash"]), height)
+            elif row[0] != str(block["hash"]):
+                raise ValueError(f"Height {height} is already active with block {row[0][:16]}...")
+
+        self._write(write)
+
+    def add_side_block(self, block: Dict) -> bool:
+        """Store ``block`` in the tree without touching the active chain; its parent must already be stored."""
+        added = []
+
+        def write(cur: sqlite3.Cursor) -> None:
+            added.append(self._insert_block(cur, block))
+
+        self._write(write)
+        return added[0]
+
+    def discard_branch(self, block_hash: str) -> int:
+        """Drop a side-branch block (e.g. one that failed validation) and all its descendants; returns how many."""
+        return self._discard_subtrees('SELECT ?', (block_hash,))
+
+    def prune_side_blocks(self, from_height: int, below_height: int) -> int:
+        """Drop side-branch blocks with ``from_height <= height < below_height`` together with their descendants.
+
+        Only non-active blocks in the height range are used as roots, so the cost follows the number of side
+        blocks there rather than the chain length.
+        """
+        return self._discard_subtrees(
+            'SELECT hash FROM block_tree WHERE height >= ? AND height < ? '
+            'AND hash NOT IN (SELECT hash FROM active_chain)',
+            (from_height, below_height),
+        )
+
+    def _discard_subtrees(self, roots_sql: str, params: Tuple) -> int:
+        discarded = []
+
+        def write(cur: sqlite3.Cursor) -> None:
+            rows = cur.execute(
+                f'''
+                WITH RECURSIVE subtree(hash) AS (
+                    {roots_sql}
+                    UNION SELECT b.hash FROM block_tree b JOIN subtree s ON b.prev_hash = s.hash
+                )
+                SELECT hash FROM subtree WHERE hash NOT IN (SELECT hash FROM active_chain)
+                ''',
+                params,
+            ).fetchall()
+            for (block_hash,) in rows:
+                cur.execute('DELETE FROM block_tree WHERE hash = ?', (block_hash,))
+                cur.execute('DELETE FROM block_deltas WHERE hash = ?', (block_hash,))
+            discarded.append(len(rows))
+
+        self._write(write)
+        return discarded[0]
+
+    def replace_chain(self, chain: List[Block]):
+
+        def write(cur: sqlite3.Cursor) -> None:
+            fork_height = self._fork_height(cur, chain)
+            self._reorganize(cur, fork_height, chain[fork_height + 1:])
+
+        self._write(write)
+
+    def reorganize(self, fork_height: int, blocks: List[Block]):
+        """Move the active chain to ``blocks`` on top of ``fork_height``; disconnected blocks stay in the tree."""
+        self._write(lambda cur: self._reorganize(cur, fork_height, blocks))
+
+    def _reorganize(self, cur: sqlite3.Cursor, fork_height: int, blocks: List[Block]) -> None:
+        self._deactivate_above(cur, fork_height)
+        for block in blocks:
+            block_dict = block.to_dict()
+            self._insert_block(cur, block_dict)
+            self._activate(cur, block.hash, block.height)
+
     def load_chain(self) -> List[Block]:
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                'SELECT height, prev_hash, timestamp, txs_json, nonce, difficulty, miner, hash FROM blocks ORDER BY height ASC'
+        rows = self._fetch_all(
+            f'SELECT {TREE_COLUMNS} FROM active_chain a JOIN block_tree b ON b.hash = a.hash ORDER BY a.height ASC'
+        )
+        return [Block.from_dict(self._row_to_dict(r), trusted=True) for r in rows]
+
+    def get_block(self, block_hash: str) -> Dict | None:
+        rows = self._fetch_all(f'SELECT {BLOCK_COLUMNS} FROM block_tree WHERE hash = ?', (block_hash,))
+        return self._row_to_dict(rows[0]) if rows else None
+
+    def has_block(self, block_hash: str) -> bool:
+        return bool(self._fetch_all('SELECT 1 FROM block_tree WHERE hash = ?', (block_hash,)))
+
+    def get_best_tip(self) -> Optional[Dict]:
+        rows = self._fetch_all('SELECT hash, height, work FROM block_tree ORDER BY work DESC, height ASC LIMIT 1')
+        if not rows:
+            return None
+        block_hash, height, work = rows[0]
+        return {"hash": block_hash, "height": int(height), "work": int(work)}
+
+    def get_branch(self, block_hash: str) -> Optional[Tuple[int, List[Dict]]]:
+        """Common ancestor height of ``block_hash`` with the active chain, and the blocks from there up to it.
+
+        One recursive query that follows parent hashes (primary-key lookups) until it reaches an active block.
+        """
+        rows = self._fetch_all(
+            f'''
+            WITH RECURSIVE branch(hash, prev_hash, active) AS (
+                SELECT hash, prev_hash, hash IN (SELECT hash FROM active_chain) FROM block_tree WHERE hash = ?
+                UNION ALL
+                SELECT b.hash, b.prev_hash, b.hash IN (SELECT hash FROM active_chain)
+                FROM block_tree b JOIN branch br ON b.hash = br.prev_hash
+                WHERE NOT br.active
             )
-            rows = cur.fetchall()
-
-        chain = []
-        for r in rows:
-            block_dict = {
-                "height": int(r[0]),
-                "prev_hash": r[1],
-                "timestamp": int(r[2]),
-                "txs": json.loads(r[3]),
-                "nonce": int(r[4]),
-                "difficulty": int(r[5]),
-                "miner": r[6],
-                "hash": r[7],
-            }
-            chain.append(Block.from_dict(block_dict))
-        return chain
-
-    def get_last_block(self) -> Dict | None:
+            SELECT br.active, {TREE_COLUMNS} FROM branch br JOIN block_tree b ON b.hash = br.hash
+            ORDER BY b.height ASC
+            ''',
+            (block_hash,),
+        )
+        if not rows or not rows[0][0]:
+            return None
+        return int(rows[0][1]), [self._row_to_dict(r[1:]) for r in rows[1:]]
+
+    def load_side_blocks(self, min_height: int) -> List[Dict]:
+        rows = self._fetch_all(
+            f'SELECT {BLOCK_COLUMNS} FROM block_tree '
+            'WHERE height >= ? AND hash NOT IN (SELECT hash FROM active_chain) ORDER BY height ASC, hash ASC',
+            (min_height,),
+        )
+        return [self._row_to_dict(r) for r in rows]
+
+    def get_active_deltas(self, min_height: int) -> Dict[str, Dict[str, float]]:
+        """Per-account balance deltas of the active blocks at ``min_height`` and above, keyed by block hash."""
+        rows = self._fetch_all(
+            'SELECT a.hash, d.public_key, d.delta FROM active_chain a LEFT JOIN block_deltas d ON d.hash = a.hash '
+            'WHERE a.height >= ?',
+            (min_height,),
+        )
+        deltas: Dict[str, Dict[str, float]] = {}
+        for block_hash, public_key, delta in rows:
+            block_deltas = deltas.setdefault(block_hash, {})
+            if public_key is not None:
+                block_deltas[public_key] = float(delta)
+        return deltas
+
+    def get_all_balances(self) -> Dict[str, float]:
+        rows = self._fetch_all('SELECT public_key, balance FROM account_balances')
+        return {public_key: float(balance) for public_key, balance in rows}
+
+    def _fetch_all(self, sql: str, params: Tuple = ()) -> List[Tuple]:
         with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                'SELECT height, prev_hash, timestamp, txs_json, nonce, difficulty, miner, hash FROM blocks ORDER BY height DESC LIMIT 1'
+            cur = conn.execute(sql, params)
+            return cur.fetchall()
+
+
+class MempoolStorage:
+    """Journal of the mempool in arrival order. Adds and removals are buffered and written in one transaction by flush()."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._ops: List[Tuple[str, str, Optional[str]]] = []
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._init_db()
+
+    def _init_db(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS mempool (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    txid TEXT NOT NULL UNIQUE,
+                    tx_json TEXT NOT NULL
+                )
+                '''
             )
-            row = cur.fetchone()
-        if not row:
-            return None
-        return {
-            "height": int(row[0]),
-            "prev_hash": row[1],
-            "timestamp": int(row[2]),
-            "txs": json.loads(row[3]),
-            "nonce": int(row[4]),
-            "difficulty": int(row[5]),
-            "miner": row[6],
-            "hash": row[7],
-        }
+            conn.commit()
+
+    def record_add(self, tx: Dict) -> None:
+        with self._lock:
+            self._ops.append(("add", str(tx["txid"]), json.dumps(tx)))
+
+    def record_remove(self, txid: str) -> None:
+        with self._lock:
+            self._ops.append(("remove", txid, None))
+
+    def flush(self) -> int:
+        # _write_lock keeps concurrent flushes from committing their batches out of order
+        with self._write_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+            if not ops:
+                return 0
+            with sqlite3.connect(self.db_path) as conn:
+                for op, txid, tx_json in ops:
+                    if op == "add":
+                        conn.execute('INSERT OR IGNORE INTO mempool (txid, tx_json) VALUES (?, ?)', (txid, tx_json))
+                    else:
+                        conn.execute('DELETE FROM mempool WHERE txid = ?', (txid,))
+                conn.commit()
+            return len(ops)
+
+    def load(self) -> List[Dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute('SELECT tx_json FROM mempool ORDER BY seq ASC').fetchall()
+        return [json.loads(row[0]) for row in rows]
@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict
+from threading import Event, RLock
+from typing import Dict, List
+
+from .mempool import Mempool
+from .transactions import SignedTransaction
+
+BLOCK_MAX_TXS = 2000
+BLOCK_MAX_BYTES = 1024 * 1024
+TEMPLATE_REFRESH_INTERVAL = 5.0
+
+
+class BlockTemplate:
+    """Transactions for the next block: the oldest mempool transactions that fit ``max_txs`` and ``max_bytes``.
+
+    The template is always a prefix of the mempool's arrival order. That prefix is a valid block body on the
+    current tip as long as the mempool keeps every transaction affordable at its place in that order: admission
+    and eviction do so, and the node re-checks the pool whenever the tip changes (``Mempool.recheck`` for a new
+    block, ``Mempool.revalidate`` after a reorg). Should a mined block still be rejected, the miner drops its
+    unaffordable transactions from the mempool. New transactions are appended while there is room, and after
+    removals only the template itself is pruned and topped up, so updates cost O(block size) regardless of the
+    mempool size.
+    """
+
+    def __init__(self, mempool: Mempool, max_txs: int = BLOCK_MAX_TXS, max_bytes: int = BLOCK_MAX_BYTES):
+        self.mempool = mempool
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.version = 0
+        self._txs: "OrderedDict[str, SignedTransaction]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._evicted_seen = mempool.evicted_count
+        self._lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self._txs)
+
+    def transactions(self) -> List[SignedTransaction]:
+        with self._lock:
+            return list(self._txs.values())
+
+    def added(self, signed_tx: SignedTransaction) -> None:
+        """Called after ``signed_tx`` was admitted to the mempool."""
+        with self._lock:
+            txid = signed_tx.transaction.txid
+            covers_mempool = len(self._txs) + 1 == len(self.mempool) and txid in self.mempool
+            if self.mempool.evicted_count != self._evicted_seen or not covers_mempool:
+                self.refresh()
+                return
+            size = self.mempool.size_of(txid)
+            if len(self._txs) < self.max_txs and self._bytes + size <= self.max_bytes:
+                self._txs[txid] = signed_tx
+                self._sizes[txid] = size
+                self._bytes += size
+                self.version += 1
+
+    def refresh(self) -> None:
+        """Drop transactions that left the mempool (mined, evicted) and top up from the oldest remaining ones."""
+        with self._lock:
+            self._evicted_seen = self.mempool.evicted_count
+            changed = False
+            for txid in [txid for txid in self._txs if txid not in self.mempool]:
+                self._bytes -= self._sizes.pop(txid)
+                del self._txs[txid]
+                changed = True
+
+            if len(self._txs) < min(self.max_txs, len(self.mempool)):
+                for signed_tx, size in self.mempool.oldest(self.max_txs, self.max_bytes):
+                    txid = signed_tx.transaction.txid
+                    if txid not in self._txs:
+                        self._txs[txid] = signed_tx
+                        self._sizes[txid] = size
+                        self._bytes += size
+                        changed = True
+            if changed:
+                self.version += 1
+
+    def reset(self) -> None:
+        """Rebuild from scratch; needed when the mempool's arrival order changed (``Mempool.revalidate``)."""
+        with self._lock:
+            self._txs.clear()
+            self._sizes.clear()
+            self._bytes = 0
+            self.refresh()
+            self.version += 1
+
+    def stale_signal(self, stop_event: Event, interval: float = TEMPLATE_REFRESH_INTERVAL) -> "_TemplateRefresh":
+        """Stop condition for mining: ``stop_event`` is set, or the template changed and ``interval`` has passed."""
+        return _TemplateRefresh(self, stop_event, interval)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "txs": len(self._txs),
+                "bytes": self._bytes,
+                "max_txs": self.max_txs,
+                "max_bytes": self.max_bytes,
+                "version": self.version,
+            }
+
+
+class _TemplateRefresh:
+    def __init__(self, template: BlockTemplate, stop_event: Event, interval: float):
+        self._template = template
+        self._stop_event = stop_event
+        self._version = template.version
+        self._deadline = time.monotonic() + interval
+
+    def is_set(self) -> bool:
+        if self._stop_event.is_set():
+            return True
+        return self._template.version != self._version and time.monotonic() >= self._deadline
@@ -1,4 +1,8 @@
-from typing import Dict, List, Optional
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes
@@ -7,6 +11,8 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from .utils import hash_dict
 
 COINBASE_SIGNATURE = "COINBASE"
+SIGNATURE_CACHE_SIZE = 100_000
+PARALLEL_VERIFY_MIN_BATCH = 32
 
 
 class Transaction:
@@ -24,15 +30,18 @@ class Transaction:
         self.recipient = recipient
         self.amount = amount
         self.timestamp = timestamp
+        self._txid: Optional[str] = None
 
     @property
     def txid(self) -> str:
-        return hash_dict({
-            "sender": self.sender,
-            "recipient": self.recipient,
-            "amount": self.amount,
-            "timestamp": self.timestamp,
-        })
+        if self._txid is None:
+            self._txid = hash_dict({
+                "sender": self.sender,
+                "recipient": self.recipient,
+                "amount": self.amount,
+                "timestamp": self.timestamp,
+            })
+        return self._txid
 
     def to_dict(self) -> Dict:
         return {
@@ -44,7 +53,7 @@ class Transaction:
         }
 
     @classmethod
-    def from_dict(cls, data: Dict) -> "Transaction":
+    def from_dict(cls, data: Dict, trusted: bool = False) -> "Transaction":
         provided_txid = data["txid"]
 
         tx = cls(
@@ -54,7 +63,9 @@ class Transaction:
             timestamp=int(data["timestamp"]),
         )
 
-        if provided_txid and str(provided_txid) != tx.txid:
+        if trusted and provided_txid:
+            tx._txid = str(provided_txid)
+        elif provided_txid and str(provided_txid) != tx.txid:
             raise ValueError(f"Invalid txid: expected {tx.txid}, got {provided_txid}")
 
         return tx
@@ -71,45 +82,192 @@ class SignedTransaction:
         return tx_dict
 
     @classmethod
-    def from_dict(cls, data: Dict) -> "SignedTransaction":
+    def from_dict(cls, data: Dict, trusted: bool = False) -> "SignedTransaction":
+        """``trusted`` skips txid and signature checks; only for data this node already validated (ChainStorage)."""
         signature = data["signature"]
-        transaction = Transaction.from_dict(data)
+        transaction = Transaction.from_dict(data, trusted=trusted)
         signed_tx = cls(transaction, signature)
 
-        if not verify_signature(signed_tx):
+        if not trusted and not verify_signature(signed_tx):
             raise ValueError(f"Invalid signature for transaction {transaction.to_dict()}")
 
         return signed_tx
 
 
+class SignatureCache:
+    """Bounded LRU set of (txid, signature, sender) triples whose ECDSA signature already verified."""
+
+    def __init__(self, maxsize: int = SIGNATURE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str, str], None]" = OrderedDict()
+        self._lock = Lock()
+
+    def contains(self, key: Tuple[str, str, str]) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key: Tuple[str, str, str]) -> None:
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+signature_cache = SignatureCache()
+
+
 def serialize_signed_transactions(txs: List[SignedTransaction]) -> List[Dict]:
     return [tx.to_dict() for tx in txs]
 
 
-def deserialize_signed_transactions(raw: List[Dict]) -> List[SignedTransaction]:
-    return [SignedTransaction.from_dict(tx) for tx in raw]
+def deserialize_signed_transactions(
+        raw: List[Dict],
+        trusted: bool = False,
+        verify_signatures: bool = True,
+) -> List[SignedTransaction]:
+    if trusted:
+        return [SignedTransaction.from_dict(tx, trusted=True) for tx in raw]
 
+    txs = [SignedTransaction(Transaction.from_dict(tx), tx["signature"]) for tx in raw]
+    if verify_signatures:
+        for signed_tx, valid in zip(txs, verify_signatures_batch(txs)):
+            if not valid:
+                raise ValueError(f"Invalid signature for transaction {signed_tx.transaction.to_dict()}")
+    return txs
 
-def verify_signature(signed_tx: SignedTransaction) -> bool:
-    public_key_hex = signed_tx.transaction.sender
-    if public_key_hex is None:
-        return signed_tx.signature == COINBASE_SIGNATURE
 
-    pub_bytes = bytes.fromhex(public_key_hex)
-    pub_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256K1(), pub_bytes)
-    signature_bytes = bytes.fromhex(signed_tx.signature)
-    txid_bytes = bytes.fromhex(signed_tx.transaction.txid)
+def _verify_ecdsa(public_key_hex: str, signature_hex: str, txid_hex: str) -> bool:
     try:
+        pub_bytes = bytes.fromhex(public_key_hex)
+        pub_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256K1(), pub_bytes)
         pub_key.verify(
-            signature_bytes,
-            txid_bytes,
+            bytes.fromhex(signature_hex),
+            bytes.fromhex(txid_hex),
             ec.ECDSA(hashes.SHA256())
         )
-    except InvalidSignature:
+    except (InvalidSignature, ValueError):
         return False
     return True
 
 
+def _verify_ecdsa_chunk(items: List[Tuple[str, str, str]]) -> List[bool]:
+    return [_verify_ecdsa(*item) for item in items]
+
+
+def verify_signature(signed_tx: SignedTransaction) -> bool:
+    public_key_hex = signed_tx.transaction.sender
+    if public_key_hex is None:
+        return signed_tx.signature == COINBASE_SIGNATURE
+
+    cache_key = (signed_tx.transaction.txid, signed_tx.signature, public_key_hex)
+    if signature_cache.contains(cache_key):
+        return True
+
+    if not _verify_ecdsa(public_key_hex, signed_tx.signature, signed_tx.transaction.txid):
+        return False
+    signature_cache.add(cache_key)
+    return True
+
+
+_verification_pool: Optional[ProcessPoolExecutor] = None
+_verification_workers = 1
+
+
+def configure_verification_pool(workers: int) -> None:
+    """Use ``workers`` processes for batch signature verification; 1 or less verifies on the calling thread."""
+    global _verification_pool, _verification_workers
+    if _verification_pool is not None:
+        _verification_pool.shutdown(wait=False, cancel_futures=True)
+        _verification_pool = None
+    _verification_workers = max(1, int(workers))
+    if _verification_workers > 1:
+        _verification_pool = ProcessPoolExecutor(
+            max_workers=_verification_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+
+def _verify_batch(txs: List[SignedTransaction], fail_fast: bool) -> List[bool]:
+    results: List[bool] = [False] * len(txs)
+    pending: List[int] = []
+    for i, signed_tx in enumerate(txs):
+        tx = signed_tx.transaction
+        if tx.sender is None:
+            results[i] = signed_tx.signature == COINBASE_SIGNATURE
+        elif signature_cache.contains((tx.txid, signed_tx.signature, tx.sender)):
+            results[i] = True
+        else:
+            pending.append(i)
+            continue
+        if fail_fast and not results[i]:
+            return results
+
+    items = [(txs[i].transaction.sender, txs[i].signature, txs[i].transaction.txid) for i in pending]
+    pool = _verification_pool
+    if pool is None or len(pending) < PARALLEL_VERIFY_MIN_BATCH:
+        for i, item in zip(pending, items):
+            results[i] = _verify_ecdsa(*item)
+            if results[i]:
+                signature_cache.add((item[2], item[1], item[0]))
+            elif fail_fast:
+                return results
+        return results
+
+    chunk_size = max(1, -(-len(pending) // (_verification_workers * 4)))
+    futures = {}
+    for start in range(0, len(pending), chunk_size):
+        future = pool.submit(_verify_ecdsa_chunk, items[start:start + chunk_size])
+        futures[future] = start
+
+    not_done = set(futures)
+    while not_done:
+        done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+        for future in done:
+            start = futures[future]
+            for offset, valid in enumerate(future.result()):
+                i = pending[start + offset]
+                item = items[start + offset]
+                results[i] = valid
+                if valid:
+                    signature_cache.add((item[2], item[1], item[0]))
+                elif fail_fast:
+                    for f in not_done:
+                        f.cancel()
+                    return results
+    return results
+
+
+def verify_signatures_batch(txs: List[SignedTransaction]) -> List[bool]:
+    return _verify_batch(txs, fail_fast=False)
+
+
+def verify_all_signatures(txs: List[SignedTransaction]) -> bool:
+    return all(_verify_batch(txs, fail_fast=True)) if txs else True
+
+
 def validate_transactions(txs: List[SignedTransaction], miner: str, mining_reward: float) -> bool:
     if len(txs) == 0:
         return True
@@ -125,7 +283,5 @@ def validate_transactions(txs: List[SignedTransaction], miner: str, mining_rewar
     for signed_tx in txs[1:]:
         if signed_tx.transaction.sender is None:
             return False
-        if not verify_signature(signed_tx):
-            return False
 
-    return True
+    return verify_all_signatures(txs[1:])
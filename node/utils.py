@@ -1,6 +1,6 @@
 import hashlib
 import json
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 
 def hash_dict(data: Dict[str, Any]) -> str:
@@ -8,3 +8,21 @@ def hash_dict(data: Dict[str, Any]) -> str:
     return hashlib.sha256(payload).hexdigest()
     # sha256 = 32 bytes * 2 chars/byte = 64 chars (1 byte = "f5")
     # digest = surowe 32 bajty, hexdigest = string representation of hex
+
+
+def merkle_leaf(txid: str, signature: str) -> str:
+    # commits to the signature as well: txids exclude it, and ECDSA signatures are malleable (s -> n - s)
+    return hashlib.sha256(bytes.fromhex(txid) + signature.encode("utf-8")).hexdigest()
+
+
+def merkle_root(hashes: List[str]) -> str:
+    if not hashes:
+        return "0" * 64
+    level = [bytes.fromhex(h) for h in hashes]
+    while len(level) > 1:
+        paired = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            # odd node is promoted as-is rather than paired with itself, so [a, b, c] and [a, b, c, c] differ
+            paired.append(level[-1])
+        level = paired
+    return level[0].hex()
@@ -1,7 +1,11 @@
 import argparse
 import logging
 
+from node.mempool import MEMPOOL_MAX_BYTES, MEMPOOL_MAX_PER_SENDER, MEMPOOL_MAX_TXS
+from node.network import HTTP_POOL_SIZE, HTTP_RETRIES
+from node.relay import TX_BATCH_WINDOW
 from node.server import NodeServer
+from node.template import BLOCK_MAX_BYTES, BLOCK_MAX_TXS
 from wallet.storage import get_public_key
 
 logging.basicConfig(
@@ -35,6 +39,26 @@ def main():
                         help='Label of account in wallet to use for public key')
     parser.add_argument('--centralized-manager', type=str, default=None,
                         help='URL of centralized graph manager (e.g., http://127.0.0.1:8080)')
+    parser.add_argument('--mining-workers', type=int, default=1,
+                        help='Number of worker processes used for mining (miner role only)')
+    parser.add_argument('--verify-workers', type=int, default=1,
+                        help='Number of worker processes used for batch signature verification')
+    parser.add_argument('--http-pool-size', type=int, default=HTTP_POOL_SIZE,
+                        help='Maximum keep-alive HTTP connections per peer')
+    parser.add_argument('--http-retries', type=int, default=HTTP_RETRIES,
+                        help='Retries (with exponential backoff) for failed peer connections')
+    parser.add_argument('--tx-relay-window', type=float, default=TX_BATCH_WINDOW,
+                        help='Seconds to collect new transactions before relaying them to peers in one batch')
+    parser.add_argument('--mempool-max-txs', type=int, default=MEMPOOL_MAX_TXS,
+                        help='Maximum number of pending transactions kept in the mempool')
+    parser.add_argument('--mempool-max-bytes', type=int, default=MEMPOOL_MAX_BYTES,
+                        help='Maximum estimated size of the mempool in bytes')
+    parser.add_argument('--mempool-max-per-sender', type=int, default=MEMPOOL_MAX_PER_SENDER,
+                        help='Maximum number of pending transactions per sender')
+    parser.add_argument('--block-max-txs', type=int, default=BLOCK_MAX_TXS,
+                        help='Maximum number of transactions the miner puts into a block')
+    parser.add_argument('--block-max-bytes', type=int, default=BLOCK_MAX_BYTES,
+                        help='Maximum estimated size of the transactions the miner puts into a block')
 
     args = parser.parse_args()
 
@@ -48,7 +72,17 @@ def main():
         seed_peers=seed_peers,
         role=args.role,
         public_key=public_key,
-        centralized_manager_url=args.centralized_manager
+        centralized_manager_url=args.centralized_manager,
+        mining_workers=args.mining_workers,
+        verify_workers=args.verify_workers,
+        http_pool_size=args.http_pool_size,
+        http_retries=args.http_retries,
+        tx_relay_window=args.tx_relay_window,
+        mempool_max_txs=args.mempool_max_txs,
+        mempool_max_bytes=args.mempool_max_bytes,
+        mempool_max_per_sender=args.mempool_max_per_sender,
+        block_max_txs=args.block_max_txs,
+        block_max_bytes=args.block_max_bytes
     )
 
     server.run()
@@ -0,0 +1,36 @@
+from itertools import count
+from typing import Dict, List
+
+from node.mempool import Mempool
+from node.transactions import COINBASE_SIGNATURE, SignedTransaction, Transaction
+
+_timestamps = count(1)
+
+
+def make_tx(sender: str, recipient: str, amount: float) -> SignedTransaction:
+    # Mempool does not verify signatures, so a placeholder is enough here; distinct timestamps keep txids unique
+    return SignedTransaction(Transaction(sender, recipient, float(amount), next(_timestamps)), "sig")
+
+
+def make_coinbase(recipient: str, amount: float) -> SignedTransaction:
+    return SignedTransaction(Transaction(None, recipient, float(amount), next(_timestamps)), COINBASE_SIGNATURE)
+
+
+def make_pool(balances: Dict[str, float], **limits) -> Mempool:
+    return Mempool(lambda public_key: balances.get(public_key, 0.0), **limits)
+
+
+def txids(*signed_txs: SignedTransaction) -> List[str]:
+    return [signed_tx.transaction.txid for signed_tx in signed_txs]
+
+
+def affordable_in_order(signed_txs: List[SignedTransaction], balances: Dict[str, float]) -> bool:
+    """Apply the transactions one by one, as block validation does, and report whether no sender went negative."""
+    running = dict(balances)
+    for signed_tx in signed_txs:
+        tx = signed_tx.transaction
+        if running.get(tx.sender, 0.0) < tx.amount:
+            return False
+        running[tx.sender] = running.get(tx.sender, 0.0) - tx.amount
+        running[tx.recipient] = running.get(tx.recipient, 0.0) + tx.amount
+    return True
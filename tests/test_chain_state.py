@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+
+from node.blockchain import BLOCK_VERSION, Block, Blockchain, ChainState
+from node.storage import ChainStorage
+from node.utils import hash_dict
+from tests.helpers import make_tx
+
+
+class ChainStateGenesisTest(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain(1)
+        self.state = ChainState(self.blockchain)
+        self.genesis = self.blockchain.create_genesis()
+        self.assertTrue(self.state.connect(self.genesis))
+        self.tip = self.blockchain.mine_next_block(self.genesis, "miner", [])
+        self.assertTrue(self.state.connect(self.tip))
+
+    def forged_genesis(self, txs) -> Block:
+        block = Block(
+            height=0,
+            prev_hash="0" * 64,
+            timestamp=1,
+            txs=txs,
+            nonce=0,
+            difficulty=self.blockchain.difficulty,
+            miner="attacker",
+            block_hash="",
+            version=BLOCK_VERSION,
+        )
+        block.hash = hash_dict(block.header())
+        return block
+
+    def test_genesis_is_not_accepted_on_top_of_a_live_tip(self):
+        coinbase = self.blockchain.create_coinbase_transaction("attacker", 1_000_000)
+        for forged in (self.forged_genesis([coinbase]), self.forged_genesis([])):
+            self.assertFalse(self.state.connect(forged))
+            self.assertFalse(self.blockchain.validate_block(forged, self.tip))
+
+        self.assertIs(self.state.tip, self.tip)
+        self.assertEqual(self.state.balance_of("attacker"), 0.0)
+
+    def test_blocks_must_extend_the_tip_by_one(self):
+        state = ChainState(self.blockchain)
+        self.assertFalse(state.connect(self.tip))
+        self.assertTrue(state.connect(self.genesis))
+        self.assertFalse(state.connect(self.genesis))
+        self.assertTrue(state.connect(self.tip))
+
+    def test_genesis_carries_no_transactions(self):
+        state = ChainState(self.blockchain)
+        coinbase = self.blockchain.create_coinbase_transaction("attacker", 1_000_000)
+        self.assertFalse(state.connect(self.forged_genesis([coinbase])))
+        self.assertIsNone(state.tip)
+
+
+class ChainStateUnaffordableTest(unittest.TestCase):
+    def test_reports_spends_not_covered_in_order_at_the_tip(self):
+        blockchain = Blockchain(1)
+        state = ChainState(blockchain)
+        genesis = blockchain.create_genesis()
+        self.assertTrue(state.connect(genesis))
+        self.assertTrue(state.connect(blockchain.mine_next_block(genesis, "miner", [])))
+
+        covered = make_tx("miner", "alice", 30)
+        overdraft = make_tx("miner", "bob", 30)
+        funded = make_tx("alice", "carol", 30)
+        early = make_tx("dave", "erin", 5)
+        late_receipt = make_tx("miner", "dave", 5)
+
+        unaffordable = state.unaffordable_transactions([covered, overdraft, funded, early, late_receipt])
+
+        self.assertEqual(unaffordable, [overdraft, early])
+        self.assertEqual(state.balance_of("miner"), 50.0)
+
+
+class ChainStateResetTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.storage = ChainStorage(self.db_path)
+        self.blockchain = Blockchain(1)
+        block = self.blockchain.create_genesis()
+        self.chain = [block]
+        for txs in ([], [make_tx("alice", "bob", 20)], [make_tx("bob", "carol", 5), make_tx("alice", "carol", 1)], []):
+            # bodies are not validated by reset(), so unsigned transactions are enough here
+            block = self.blockchain.mine_next_block(block, f"miner{len(self.chain)}", txs)
+            self.chain.append(block)
+        self.storage.replace_chain(self.chain)
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def test_undo_is_rebuilt_from_stored_deltas(self):
+        state = ChainState(self.blockchain)
+        state.reset(self.chain, self.storage.get_all_balances(), self.storage.get_active_deltas(0))
+
+        self.assertTrue(state.can_disconnect(len(self.chain) - 1))
+        for height in range(len(self.chain) - 2, 0, -1):
+            state.disconnect(self.chain[height])
+            expected = ChainState(self.blockchain)
+            expected.reset(self.chain[:height + 1])
+            self.assertIs(state.tip, self.chain[height])
+            for public_key in ("alice", "bob", "carol", "miner1", "miner2", "miner3", "miner4"):
+                self.assertAlmostEqual(state.balance_of(public_key), expected.balance_of(public_key))
+
+    def test_undo_covers_only_the_blocks_whose_deltas_are_given(self):
+        state = ChainState(self.blockchain)
+        state.reset(self.chain, self.storage.get_all_balances(), self.storage.get_active_deltas(3))
+
+        self.assertTrue(state.can_disconnect(2))
+        self.assertFalse(state.can_disconnect(3))
+
+
+if __name__ == "__main__":
+    unittest.main()
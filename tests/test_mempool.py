@@ -0,0 +1,165 @@
+import unittest
+
+from node.mempool import Mempool
+from tests.helpers import affordable_in_order, make_coinbase, make_pool, make_tx, txids
+
+
+class MempoolEvictionTest(unittest.TestCase):
+    def test_evicting_a_receipt_evicts_the_spends_that_relied_on_it(self):
+        pool = make_pool({"alice": 10, "dave": 5}, max_txs=3)
+        receipt = make_tx("alice", "bob", 10)
+        spend_1 = make_tx("bob", "carol", 6)
+        spend_2 = make_tx("bob", "carol", 4)
+        for signed_tx in (receipt, spend_1, spend_2):
+            pool.add(signed_tx)
+
+        newcomer = make_tx("dave", "erin", 1)
+        pool.add(newcomer)
+
+        self.assertEqual(pool.txids(), txids(newcomer))
+        stats = pool.stats()
+        self.assertEqual(stats["evicted"], 3)
+        self.assertEqual(stats["evicted_dependent"], 2)
+        self.assertEqual(pool.balance_delta("bob"), 0.0)
+
+    def test_cascade_stops_once_the_recipient_is_solvent_again(self):
+        pool = make_pool({"alice": 10, "bob": 6, "dave": 5}, max_txs=3)
+        receipt = make_tx("alice", "bob", 10)
+        older_spend = make_tx("bob", "carol", 6)
+        newer_spend = make_tx("bob", "carol", 4)
+        for signed_tx in (receipt, older_spend, newer_spend):
+            pool.add(signed_tx)
+
+        newcomer = make_tx("dave", "erin", 1)
+        pool.add(newcomer)
+
+        self.assertEqual(pool.txids(), txids(older_spend, newcomer))
+        self.assertEqual(pool.stats()["evicted_dependent"], 1)
+        self.assertGreaterEqual(pool.available("bob"), 0)
+
+    def test_cascade_follows_chains_of_receipts(self):
+        pool = make_pool({"alice": 5, "dave": 5}, max_txs=3)
+        chain = [make_tx("alice", "bob", 5), make_tx("bob", "carol", 5), make_tx("carol", "frank", 5)]
+        for signed_tx in chain:
+            pool.add(signed_tx)
+
+        pool.add(make_tx("dave", "erin", 1))
+
+        self.assertEqual(len(pool), 1)
+        for public_key in ("alice", "bob", "carol", "frank"):
+            self.assertEqual(pool.balance_delta(public_key), 0.0)
+
+    def test_spend_ahead_of_its_replacement_receipt_is_evicted(self):
+        balances = {"alice": 10, "dave": 10, "erin": 1}
+        pool = make_pool(balances, max_txs=3)
+        receipt = make_tx("alice", "bob", 10)
+        spend = make_tx("bob", "carol", 10)
+        later_receipt = make_tx("dave", "bob", 10)
+        for signed_tx in (receipt, spend, later_receipt):
+            pool.add(signed_tx)
+
+        # bob is solvent in total without ``receipt``, but ``spend`` comes before ``later_receipt``
+        newcomer = make_tx("erin", "frank", 1)
+        pool.add(newcomer)
+
+        self.assertEqual(pool.txids(), txids(later_receipt, newcomer))
+        self.assertEqual(pool.stats()["evicted_dependent"], 1)
+        self.assertTrue(affordable_in_order(pool.transactions(), balances))
+
+    def test_recheck_drops_spends_that_conflict_with_a_confirmed_block(self):
+        balances = {"alice": 50, "erin": 1}
+        pool = make_pool(balances)
+        pending = make_tx("alice", "carol", 50)
+        onward = make_tx("carol", "dave", 20)
+        unrelated = make_tx("erin", "frank", 1)
+        for signed_tx in (pending, onward, unrelated):
+            pool.add(signed_tx)
+
+        # a block spending alice's 50 elsewhere connected
+        balances["alice"] = 0
+        dropped = pool.recheck(["alice"])
+
+        self.assertEqual(txids(*dropped), txids(pending, onward))
+        self.assertEqual(pool.txids(), txids(unrelated))
+        self.assertEqual(pool.stats()["dropped_invalid"], 2)
+        self.assertEqual(pool.available("alice"), 0)
+
+
+class MempoolRevalidateTest(unittest.TestCase):
+    def test_restored_transactions_go_first_so_pending_spends_keep_their_funding(self):
+        balances = {"alice": 10}
+        pool = make_pool(balances)
+        restored_1 = make_tx("alice", "bob", 5)
+        restored_2 = make_tx("bob", "carol", 5)
+        balances.update(bob=5, carol=5)
+        pending = make_tx("carol", "dave", 5)
+        pool.add(pending)
+
+        # the block that confirmed restored_1 and restored_2 was disconnected
+        balances.clear()
+        balances["alice"] = 10
+        restored, dropped = pool.revalidate([restored_1, restored_2])
+
+        self.assertEqual((restored, dropped), (2, 0))
+        self.assertEqual(pool.txids(), txids(restored_1, restored_2, pending))
+
+    def test_drops_unaffordable_and_confirmed_transactions_in_one_pass(self):
+        balances = {"alice": 10, "bob": 3}
+        pool = make_pool(balances)
+        confirmed = make_tx("alice", "carol", 4)
+        first = make_tx("alice", "dave", 3)
+        second = make_tx("alice", "dave", 3)
+        independent = make_tx("bob", "erin", 3)
+        for signed_tx in (confirmed, first, second, independent):
+            pool.add(signed_tx)
+
+        # the new tip confirms ``confirmed`` plus a conflicting spend of 3 that this pool never saw
+        balances["alice"] = 3
+        restored, dropped = pool.revalidate([], exclude=txids(confirmed))
+
+        self.assertEqual((restored, dropped), (0, 1))
+        self.assertEqual(pool.txids(), txids(first, independent))
+        self.assertEqual(pool.balance_delta("alice"), -3)
+        stats = pool.stats()
+        self.assertEqual((stats["restored"], stats["dropped_invalid"]), (0, 1))
+
+    def test_restored_transactions_already_pending_or_confirmed_are_skipped(self):
+        balances = {"alice": 10}
+        pool = make_pool(balances)
+        pending = make_tx("alice", "bob", 2)
+        pool.add(pending)
+        reconfirmed = make_tx("alice", "bob", 1)
+        coinbase = make_coinbase("miner", 50)
+
+        restored, dropped = pool.revalidate([coinbase, pending, reconfirmed], exclude=txids(reconfirmed))
+
+        self.assertEqual((restored, dropped), (0, 0))
+        self.assertEqual(pool.txids(), txids(pending))
+
+    def test_digest_and_journal_follow_the_rebuilt_order(self):
+        journal = []
+
+        class Journal:
+            def record_add(self, tx):
+                journal.append(("add", tx["txid"]))
+
+            def record_remove(self, txid):
+                journal.append(("remove", txid))
+
+        balances = {"alice": 10}
+        pool = Mempool(lambda public_key: balances.get(public_key, 0.0), journal=Journal())
+        pending = make_tx("alice", "bob", 2)
+        pool.add(pending)
+        digest_before = pool.digest()
+        restored_tx = make_tx("alice", "carol", 1)
+
+        pool.revalidate([restored_tx])
+
+        self.assertEqual(journal[-2:], [("add", restored_tx.transaction.txid), ("add", pending.transaction.txid)])
+        self.assertNotEqual(pool.digest(), digest_before)
+        pool.remove(txids(restored_tx))
+        self.assertEqual(pool.digest(), digest_before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from node.blockchain import Blockchain
+from node.storage import ChainStorage
+
+
+class ChainStoragePruneTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.storage = ChainStorage(self.db_path)
+        self.blockchain = Blockchain(1)
+        block = self.blockchain.create_genesis()
+        self.chain = [block]
+        for _ in range(5):
+            block = self.blockchain.mine_next_block(block, "miner", [])
+            self.chain.append(block)
+        self.storage.replace_chain(self.chain)
+
+        # side branch forking off height 1: side_root at height 2, side_child at height 3
+        self.side_root = self.blockchain.mine_next_block(self.chain[1], "rival", [])
+        self.side_child = self.blockchain.mine_next_block(self.side_root, "rival", [])
+        for side_block in (self.side_root, self.side_child):
+            self.assertTrue(self.storage.add_side_block(side_block.to_dict()))
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def test_prunes_side_subtrees_rooted_in_the_range(self):
+        self.assertEqual(self.storage.prune_side_blocks(0, 3), 2)
+
+        self.assertFalse(self.storage.has_block(self.side_root.hash))
+        self.assertFalse(self.storage.has_block(self.side_child.hash))
+        self.assertEqual([blk.hash for blk in self.storage.load_chain()], [blk.hash for blk in self.chain])
+
+    def test_leaves_side_blocks_outside_the_range(self):
+        self.assertEqual(self.storage.prune_side_blocks(4, 6), 0)
+        self.assertEqual(self.storage.prune_side_blocks(0, 2), 0)
+
+        self.assertTrue(self.storage.has_block(self.side_root.hash))
+        self.assertTrue(self.storage.has_block(self.side_child.hash))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+from node.mempool import Mempool
+from node.template import BlockTemplate
+from node.transactions import SignedTransaction
+from tests.helpers import affordable_in_order, make_tx
+
+
+class BlockTemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.balances = {"alice": 10, "dave": 5}
+        self.mempool = Mempool(lambda public_key: self.balances.get(public_key, 0.0))
+
+    def add(self, template: BlockTemplate, signed_tx: SignedTransaction) -> None:
+        self.mempool.add(signed_tx)
+        template.added(signed_tx)
+
+    def assertValidPrefix(self, template: BlockTemplate) -> None:
+        body = template.transactions()
+        self.assertEqual([signed_tx.transaction.txid for signed_tx in body], self.mempool.txids()[:len(body)])
+        for end in range(len(body) + 1):
+            self.assertTrue(affordable_in_order(body[:end], self.balances), f"prefix of {end} is not affordable")
+
+    def test_every_prefix_of_dependent_spends_is_a_valid_block_body(self):
+        template = BlockTemplate(self.mempool, max_txs=3)
+        for signed_tx in (make_tx("alice", "bob", 10), make_tx("bob", "carol", 6),
+                          make_tx("carol", "erin", 6), make_tx("bob", "frank", 4)):
+            self.add(template, signed_tx)
+
+        self.assertEqual(len(template), 3)
+        self.assertValidPrefix(template)
+
+    def test_template_stays_a_prefix_after_removals(self):
+        template = BlockTemplate(self.mempool, max_txs=2)
+        receipt = make_tx("alice", "bob", 10)
+        for signed_tx in (receipt, make_tx("bob", "carol", 6), make_tx("dave", "erin", 5)):
+            self.add(template, signed_tx)
+
+        # ``receipt`` was mined, so its effect is now part of the confirmed balances
+        self.balances.update(alice=0, bob=10)
+        self.mempool.remove([receipt.transaction.txid])
+        template.refresh()
+
+        self.assertEqual(len(template), 2)
+        self.assertValidPrefix(template)
+
+    def test_template_stays_a_prefix_after_eviction(self):
+        self.mempool.max_txs = 3
+        template = BlockTemplate(self.mempool, max_txs=2)
+        for signed_tx in (make_tx("alice", "bob", 10), make_tx("bob", "carol", 4), make_tx("dave", "erin", 1)):
+            self.add(template, signed_tx)
+
+        self.add(template, make_tx("dave", "frank", 2))
+
+        self.assertEqual(len(self.mempool), 2)
+        self.assertValidPrefix(template)
+
+    def test_reset_follows_the_order_rebuilt_by_revalidate(self):
+        template = BlockTemplate(self.mempool)
+        pending = make_tx("alice", "bob", 3)
+        self.add(template, pending)
+        restored = make_tx("dave", "carol", 5)
+        self.balances["carol"] = 5
+        self.add(template, make_tx("carol", "erin", 5))
+
+        # the block that paid carol was disconnected and its transaction returns ahead of the pending ones
+        del self.balances["carol"]
+        self.mempool.revalidate([restored])
+        template.reset()
+
+        self.assertEqual(template.transactions()[0], restored)
+        self.assertEqual(len(template), 3)
+        self.assertValidPrefix(template)
+
+    def test_byte_limit_truncates_without_skipping(self):
+        template = BlockTemplate(self.mempool)
+        signed_txs = [make_tx("alice", "bob", 1) for _ in range(4)]
+        for signed_tx in signed_txs:
+            self.mempool.add(signed_tx)
+        template.max_bytes = sum(self.mempool.size_of(signed_tx.transaction.txid) for signed_tx in signed_txs[:2])
+        template.refresh()
+
+        self.assertEqual(template.transactions(), signed_txs[:2])
+        self.assertValidPrefix(template)
+
+
+if __name__ == "__main__":
+    unittest.main()